@@ -0,0 +1,58 @@
+"""Compare expression parsing against the stdlib tokenize module.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_expression
+"""
+
+import io
+import timeit
+import tokenize
+
+import stencil
+
+SOURCES = [
+    "user.name",
+    "item.id",
+    "row['title']",
+    "url('product', item.slug, 3)",
+    "order.lines[0].product.price",
+    "format_date(post.published, 'Y-m-d')",
+]
+
+
+def lex_tokenize():
+    for src in SOURCES:
+        for _ in tokenize.generate_tokens(io.StringIO(src).readline):
+            pass
+
+
+def lex_stencil():
+    for src in SOURCES:
+        for _ in stencil.tokenise_expression(src):
+            pass
+
+
+def parse_uncached():
+    for src in SOURCES:
+        stencil.Expression.parse.__wrapped__(src)
+
+
+def parse_cached():
+    for src in SOURCES:
+        stencil.Expression.parse(src)
+
+
+def main(number=5000):
+    results = {}
+    for func in (lex_tokenize, lex_stencil, parse_uncached, parse_cached):
+        elapsed = min(timeit.repeat(func, number=number, repeat=5))
+        results[func.__name__] = elapsed
+        rate = number * len(SOURCES) / elapsed
+        print(f"{func.__name__:16} {elapsed * 1e6 / (number * len(SOURCES)):8.2f} us/expr {rate:12,.0f} expr/s")
+    print(f"lexing speedup vs tokenize: {results['lex_tokenize'] / results['lex_stencil']:.1f}x")
+    print(f"parse cache speedup: {results['parse_uncached'] / results['parse_cached']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
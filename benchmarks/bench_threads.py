@@ -0,0 +1,62 @@
+"""Render the same inherited templates from several threads at once.
+
+Checks every result, and reports throughput for each thread count.  On a
+free-threaded build of Python this should scale with the number of cores.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_threads
+"""
+
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import stencil
+
+TEMPLATES = {
+    "base.html": "<html><head><title>{% block title %}Site{% endblock %}</title></head>"
+    "<body>{% block body %}{% endblock %}</body></html>",
+    "layout.html": '{% extends "base.html" %}{% block title %}{{ block.super }} - {{ section }}{% endblock %}'
+    "{% block body %}<main>{% block content %}{% endblock %}</main>{% endblock %}",
+    "page.html": '{% extends "layout.html" %}{% block title %}{{ title }} | {{ block.super }}{% endblock %}'
+    '{% block content %}<table>{% for row in rows %}{% include "row.html" row=row %}{% endfor %}</table>'
+    "{% endblock %}",
+    "row.html": "<tr><td>{{ row[0] }}</td><td>{{ row[1] }}</td></tr>",
+}
+
+
+def expected(n):
+    rows = "".join(f"<tr><td>{i}</td><td>{n}</td></tr>" for i in range(50))
+    return (
+        f"<html><head><title>Page {n} | Site - Docs</title></head>"
+        f"<body><main><table>{rows}</table></main></body></html>"
+    )
+
+
+def main(renders=2000):
+    with tempfile.TemporaryDirectory() as root:
+        for name, src in TEMPLATES.items():
+            (Path(root) / name).write_text(src)
+
+        for compiled in (False, True):
+            loader = stencil.TemplateLoader([root], compiled=compiled)
+
+            def render(n):
+                data = {"title": f"Page {n}", "section": "Docs", "rows": [(i, n) for i in range(50)]}
+                result = loader["page.html"].render(data)
+                if result != expected(n):
+                    raise AssertionError(f"Output mismatch for render {n}")
+
+            for threads in (1, 2, 4, 8):
+                start = time.perf_counter()
+                with ThreadPoolExecutor(threads) as pool:
+                    list(pool.map(render, range(renders)))
+                elapsed = time.perf_counter() - start
+                mode = "compiled" if compiled else "interpreted"
+                print(f"{mode:12} {threads} threads: {renders / elapsed:10,.0f} renders/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Benchmark tokenising, parsing and rendering across a set of typical workloads.
+
+Run from the repository root:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --save baseline.json
+    python -m benchmarks.run --compare baseline.json
+
+Every workload is built from fixed data, and timings are the best of several
+repeats, so results from one machine can be compared over time.  With
+``--compare``, the exit status is 1 if any result is worse than the baseline by
+more than ``--threshold`` percent.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+import stencil
+
+
+def loop_table():
+    templates = {
+        "table.html": '<table>{% for row in rows %}<tr class="{% if loop.first %}first{% endif %}">'
+        "{% for cell in row.cells %}<td>{{ cell }}</td>{% endfor %}<td>{{ row.total }}</td>"
+        "<td>{{ loop.index }}/{{ loop.length }}</td></tr>{% endfor %}</table>",
+    }
+    rows = [SimpleNamespace(cells=[f"r{i}c{j}" for j in range(8)], total=i * 8) for i in range(500)]
+    return templates, "table.html", {"rows": rows}
+
+
+def deep_inheritance(depth=12, blocks=6):
+    names = [f"block{b}" for b in range(blocks)]
+    templates = {
+        "level0.html": "<html>"
+        + "".join(f"<div id={name}>{{% block {name} %}}{name}{{% endblock %}}</div>" for name in names)
+        + "</html>",
+    }
+    for level in range(1, depth):
+        templates[f"level{level}.html"] = f'{{% extends "level{level - 1}.html" %}}' + "".join(
+            f"{{% block {name} %}}<{level}>{{{{ block.super }}}}{{{{ title }}}}{{% endblock %}}" for name in names
+        )
+    return templates, f"level{depth - 1}.html", {"title": "Inherited"}
+
+
+def include_fanout(parts=20, items=100):
+    templates = {
+        "page.html": "".join(f'{{% include "part{p}.html" %}}' for p in range(parts))
+        + '{% for item in items %}{% include "item.html" item=item n=loop.index %}{% endfor %}',
+        "item.html": '<li>{{ n }}: {{ item.name }} {% include "leaf.html" value=item.price %}</li>',
+        "leaf.html": "<span>{{ value }}</span>",
+    }
+    for p in range(parts):
+        templates[f"part{p}.html"] = f'<section>{{{{ title }}}} {p}{{% include "leaf.html" value={p} %}}</section>'
+    data = [SimpleNamespace(name=f"Item {i}", price=i * 1.25) for i in range(items)]
+    return templates, "page.html", {"title": "Fan out", "items": data}
+
+
+def escape_heavy():
+    templates = {
+        "escape.html": '{% for comment in comments %}<p title="{{ comment.author }}">{{ comment.body }}</p>'
+        "<small>{{ comment.score }}</small>{% endfor %}",
+    }
+    comments = [
+        SimpleNamespace(
+            author=f'O\'Brien & "Sons" #{i}',
+            body=f"<script>alert({i})</script> & <b>bold</b> 'quoted' \"text\" " * 3,
+            score=i,
+        )
+        for i in range(500)
+    ]
+    return templates, "escape.html", {"comments": comments}
+
+
+class Order:
+    def __init__(self, i):
+        self.customer = SimpleNamespace(profile=SimpleNamespace(name=f"Customer {i}", email=f"c{i}@example.com"))
+        self.lines = [SimpleNamespace(product=SimpleNamespace(title=f"P{i}-{j}", price=j * 2.5)) for j in range(3)]
+        self.total, self.kind = i * 3.3, i % 3
+        self.meta = {"status": "paid"}
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+def expression_heavy():
+    templates = {
+        "expr.html": "{% for order in orders %}{{ order.customer.profile.name }} {{ order.lines[0].product.title }} "
+        "{{ order['meta']['status'] }} {{ fmt(order.total, 2) }} {{ order.lines[1].product.price }} "
+        "{{ labels[order.kind] }} {{ order.customer.profile.email }}\n{% endfor %}",
+    }
+    data = {
+        "orders": [Order(i) for i in range(300)],
+        "labels": ["new", "paid", "shipped"],
+        "fmt": lambda value, places: f"{value:.{places}f}",
+    }
+    return templates, "expr.html", data
+
+
+WORKLOADS = {
+    "loop_table": loop_table,
+    "deep_inheritance": deep_inheritance,
+    "include_fanout": include_fanout,
+    "escape_heavy": escape_heavy,
+    "expression_heavy": expression_heavy,
+}
+
+# Higher is better for rates; lower is better for memory.
+METRICS = {
+    "tokenise_mb_s": "tokenise MB/s",
+    "parse_per_s": "parse templates/s",
+    "render_per_s": "render/s",
+    "compiled_per_s": "compiled render/s",
+    "peak_kib": "peak KiB/render",
+}
+
+
+def best(func, repeat, min_time=0.2):
+    number, elapsed = 1, 0
+    while elapsed < min_time:  # Calibrate so each timing is long enough to be stable
+        number *= 2
+        elapsed = timeit.timeit(func, number=number)
+    return number / min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def measure(root, templates, entry, data, repeat):
+    sources = list(templates.values())
+    size = sum(len(src) for src in sources) / 1e6
+
+    def tokenise():
+        for src in sources:
+            for _ in stencil.tokenise(src):
+                pass
+
+    def parse():
+        stencil.Expression.parse.cache_clear()
+        loader = stencil.TemplateLoader([root])
+        for name in templates:
+            loader.load(name)
+
+    loader = stencil.TemplateLoader([root])
+    compiled = stencil.TemplateLoader([root], compiled=True)
+    tmpl, compiled_tmpl = loader[entry], compiled[entry]
+    expected = tmpl.render(data)
+    if compiled_tmpl.render(data) != expected:
+        raise AssertionError(f"Compiled output differs for {entry}")
+
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    tmpl.render(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "tokenise_mb_s": best(tokenise, repeat) * size,
+        "parse_per_s": best(parse, repeat) * len(templates),
+        "render_per_s": best(lambda: tmpl.render(data), repeat),
+        "compiled_per_s": best(lambda: compiled_tmpl.render(data), repeat),
+        "peak_kib": peak / 1024,
+    }
+
+
+def compare(name, metric, value, baseline, threshold):
+    """Return the change against the baseline as a percentage improvement, and whether it is a regression."""
+    old = baseline.get(name, {}).get(metric)
+    if not old:
+        return "", False
+    change = (value / old - 1) * 100
+    if metric == "peak_kib":
+        change = -change
+    return f"{change:+7.1f}%", change < -threshold
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.split("\n")[0])
+    parser.add_argument("workloads", nargs="*", help=f"workloads to run (default: all of {', '.join(WORKLOADS)})")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats; the best is reported")
+    parser.add_argument("--save", type=Path, help="write results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="compare against results saved with --save")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change counted as a regression")
+    args = parser.parse_args(argv)
+    unknown = set(args.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+
+    baseline = json.loads(args.compare.read_text())["results"] if args.compare else {}
+    results, regressions = {}, []
+    print(f"stencil {stencil.__version__}, Python {platform.python_version()} ({platform.python_implementation()})")
+    for name in args.workloads or WORKLOADS:
+        templates, entry, data = WORKLOADS[name]()
+        with tempfile.TemporaryDirectory() as root:
+            for tmpl_name, src in templates.items():
+                (Path(root) / tmpl_name).write_text(src)
+            results[name] = measure(root, templates, entry, data, args.repeat)
+        print(f"\n{name}")
+        for metric, label in METRICS.items():
+            value = results[name][metric]
+            change, regressed = compare(name, metric, value, baseline, args.threshold)
+            if regressed:
+                regressions.append(f"{name} {label}")
+            print(f"  {label:20} {value:14,.1f} {change}{'  REGRESSION' if regressed else ''}")
+
+    if args.save:
+        meta = {"stencil": stencil.__version__, "python": platform.python_version(), "machine": platform.machine()}
+        args.save.write_text(json.dumps({"meta": meta, "results": results}, indent=2))
+    if regressions:
+        print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,34 @@
+import argparse
+import asyncio
+import codecs
+import contextvars
+import copy
+import ctypes
+import ctypes.util
+import hashlib
 import html
 import importlib
+import inspect
+import os
+import pickle
 import re
+import select
+import struct
+import sys
+import tempfile
+import threading
+import time
 import token
-import tokenize
-from collections import ChainMap, defaultdict, deque, namedtuple
+import traceback
+from abc import ABC, abstractmethod
+from collections import ChainMap, Counter, defaultdict, deque, namedtuple
 from collections.abc import Iterable
-from io import StringIO
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from io import BytesIO, StringIO
+from itertools import groupby
+from operator import attrgetter, itemgetter
 from pathlib import Path
 from typing import ClassVar
 
@@ -17,7 +40,13 @@ TOK_VAR = "var"
 TOK_BLOCK = "block"
 
 tag_re = re.compile(r"{%\s*(?P<block>.+?)\s*%}|{{\s*(?P<var>.+?)\s*}}|{#\s*(?P<comment>.+?)\s*#}", re.DOTALL)
-Token = namedtuple("Token", "type content")
+Token = namedtuple("Token", "type content line", defaults=(None,))
+CONSTANTS = {"True": True, "False": False, "None": None}
+MISSING = object()
+CacheInfo = namedtuple("CacheInfo", "hits misses evictions currsize maxsize")
+PreloadResult = namedtuple("PreloadResult", "name seconds error")
+NodeStats = namedtuple("NodeStats", "calls total own")
+Analysis = namedtuple("Analysis", "variables paths locals templates")
 
 
 class SafeStr(str):
@@ -27,45 +56,742 @@ class SafeStr(str):
         return self
 
 
+class Text(str):
+    """Template text, with its UTF-8 encoding prepared once for byte output."""
+
+    def __new__(cls, value):
+        self = super().__new__(cls, value)
+        self.encoded = value.encode()
+        return self
+
+    def __reduce__(self):
+        return Text, (str(self),)
+
+
+class ByteSink:
+    """A text output which encodes what is written to it into a binary target, in batches.
+
+    The target may be a ``bytearray``, a socket (written to with ``sendmsg``), or a binary file-like object (written to
+    with ``writelines``).  Encoded chunks are collected until at least ``flush_size`` bytes are waiting.
+    """
+
+    IOV_MAX = 1024  # Chunks per sendmsg call
+
+    def __init__(self, target=None, encoding="utf-8", flush_size=65536):
+        self.target = bytearray() if target is None else target
+        self.encoding = encoding
+        self.utf8 = codecs.lookup(encoding).name == "utf-8"
+        # Stateful encodings (such as UTF-16, with its BOM) must see the output as one stream.
+        self.encode = str.encode if self.utf8 else codecs.getincrementalencoder(encoding)().encode
+        self.flush_size = flush_size
+        self.chunks, self.size = [], 0
+        if isinstance(self.target, bytearray):
+            self.send = self.extend
+        elif hasattr(self.target, "sendmsg"):
+            self.send = self.sendmsg
+        else:
+            self.send = self.target.writelines
+
+    def write(self, text):
+        data = text.encoded if type(text) is Text and self.utf8 else self.encode(text)
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.flush_size:
+            self.send_pending()
+        return len(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def send_pending(self):
+        if self.chunks:
+            chunks, self.chunks, self.size = self.chunks, [], 0
+            self.send(chunks)
+
+    def flush(self):
+        self.send_pending()
+        if hasattr(self.target, "flush"):
+            self.target.flush()
+
+    def extend(self, chunks):
+        self.target.extend(b"".join(chunks))
+
+    def sendmsg(self, chunks):
+        chunks = [memoryview(chunk) for chunk in chunks]
+        while chunks:
+            sent = self.target.sendmsg(chunks[: self.IOV_MAX])
+            while chunks and sent >= len(chunks[0]):
+                sent -= len(chunks.pop(0))
+            if sent:
+                chunks[0] = chunks[0][sent:]
+
+    def getvalue(self):
+        self.send_pending()
+        return bytes(self.target)
+
+
+# Escape functions which only replace &<>"', so can be skipped for text without them.
+HTML_ESCAPES = {html.escape}
+
+
+def format_value(value, escape):
+    """Convert a value to text for output, escaping it unless it is marked safe or can't need it."""
+    kind = type(value)
+    try:
+        plain = escape in HTML_ESCAPES
+    except TypeError:  # An unhashable escape function can't be one of them
+        plain = False
+    if kind is str:
+        # Much quicker than escaping, for the common case of text with nothing to escape
+        if plain and not (
+            "&" in value or "<" in value or ">" in value or '"' in value or "'" in value
+        ):  # fmt: skip
+            return value
+        return escape(value)
+    if (kind is int or kind is float or kind is bool) and plain:
+        return str(value)
+    if hasattr(value, "__html__"):
+        return value.__html__()
+    value = str(value)
+    if getattr(value, "__safe__", False):
+        return value
+    return escape(value)
+
+
 def tokenise(template):
-    upto = 0
+    upto, line = 0, 1
     for match in tag_re.finditer(template):
         start, end = match.span()
         if upto < start:
-            yield Token(TOK_TEXT, template[upto:start])
+            yield Token(TOK_TEXT, template[upto:start], line)
+            line += template.count("\n", upto, start)
         upto = end
         mode = match.lastgroup
-        yield Token(mode, match[mode].strip())
+        yield Token(mode, match[mode].strip(), line)
+        line += template.count("\n", start, end)
     if upto < len(template):
-        yield Token(TOK_TEXT, template[upto:])
+        yield Token(TOK_TEXT, template[upto:], line)
+
+
+class _LoaderPickler(pickle.Pickler):
+    # Templates refer back to their loader; store a placeholder and re-bind it when loading.
+    def __init__(self, file, loader):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.loader = loader
+
+    def persistent_id(self, obj):
+        return "loader" if obj is self.loader else None
+
+
+class _LoaderUnpickler(pickle.Unpickler):
+    def __init__(self, file, loader):
+        super().__init__(file)
+        self.loader = loader
+
+    def persistent_load(self, pid):
+        if pid != "loader":
+            raise pickle.UnpicklingError(f"Unknown persistent id: {pid!r}")
+        return self.loader
 
 
 class TemplateLoader(dict):
-    def __init__(self, paths):
+    def __init__(  # noqa: PLR0913 - all settings, given by keyword
+        self, paths, *, compiled=False, cache_dir=None, maxsize=None, check_interval=None, fragment_cache=None
+    ):  # fmt: skip
         self.paths = [Path(path).resolve() for path in paths]
-
-    def load(self, name, encoding="utf8"):
+        self.compiled = compiled
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.maxsize, self.check_interval = maxsize, check_interval
+        self.fragment_cache = fragment_cache  # For {% cache %}; CacheTag.backend when None
+        self.hits = self.misses = self.evictions = 0
+        self.sources = {}  # name: (path, (mtime, size), last checked)
+        self.lock = threading.RLock()
+        self.loading = {}  # name: Future, for loads in progress
+        self.waiting = {}  # thread id: Future it is waiting on
+        self.dependents = defaultdict(set)  # name: names of the templates linked to it
+
+    def __reduce__(self):
+        # Locks can't be pickled, so rebuild from the settings, with an empty cache.
+        settings = {
+            "compiled": self.compiled, "cache_dir": self.cache_dir, "maxsize": self.maxsize,
+            "check_interval": self.check_interval, "fragment_cache": self.fragment_cache,
+        }  # fmt: skip
+        return partial(type(self), self.paths, **settings), ()
+
+    def find(self, name):
         for path in self.paths:
             full_path = path / name
             if full_path.is_file():
-                return Template(full_path.read_text(encoding), loader=self, name=name)
+                return full_path
         raise LookupError(name)
 
+    def load(self, name, encoding="utf8"):
+        src = self.find(name).read_text(encoding)
+        if self.cache_dir is not None:
+            tmpl = self.load_cached(src, name)
+        else:
+            tmpl = Template(src, loader=self, name=name)
+        self.link(tmpl)
+        return tmpl.compile() if self.compiled else tmpl
+
+    def link(self, tmpl):
+        """Resolve literal includes, and the blocks of a template which extends a named parent.
+
+        Afterwards, the template renders like a plain template.
+        """
+        for include in tmpl.nodelist.nodes_by_type(IncludeTag):
+            name = constant_value(include.template_name)
+            if not isinstance(name, str):
+                continue
+            try:
+                target = self[name]
+            except Exception:  # noqa: S112 - recursive, missing or broken: leave it to fail, if ever, when rendered
+                continue
+            if target.extends is None and not any(target.nodelist.nodes_by_type(BlockTag)):
+                include.template = target
+                tmpl.dependencies[name] = target
+        extends = tmpl.extends
+        parent_name = None if extends is None else constant_value(extends.parent)
+        if not isinstance(parent_name, str):
+            return tmpl  # Decided at render time
+        parent = self[parent_name]
+        if parent.blocks is None:
+            return tmpl
+        blocks = Template.find_blocks(extends.nodelist)
+        for block_name, parent_blocks in parent.blocks.items():
+            blocks.setdefault(block_name, []).extend(parent_blocks)
+        tmpl.blocks, tmpl.base = blocks, parent.base
+        tmpl.nodelist = link_blocks(parent.base, blocks)
+        tmpl.dependencies[parent_name] = parent
+        return tmpl
+
+    def load_cached(self, src, name):
+        key = hashlib.sha256(f"{__version__}\0{src}".encode()).hexdigest()
+        cache_file = self.cache_dir / f"{key}.pickle"
+        try:
+            tmpl = self.loads(cache_file.read_bytes())
+        except Exception:  # A missing, stale or corrupt entry is just a cache miss
+            tmpl = None
+        if tmpl is not None:
+            tmpl.name = name
+            return tmpl
+
+        tmpl = Template(src, loader=self, name=name)
+        fout = None
+        try:
+            data = self.dumps(tmpl)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".tmp", delete=False) as fout:
+                fout.write(data)
+            os.replace(fout.name, cache_file)
+        except (OSError, pickle.PicklingError, AttributeError, TypeError):
+            # Storing it is best-effort: the template parsed, so use it anyway.
+            if fout is not None:
+                Path(fout.name).unlink(missing_ok=True)
+        return tmpl
+
+    def dumps(self, tmpl):
+        buf = BytesIO()
+        _LoaderPickler(buf, self).dump(tmpl)
+        return buf.getvalue()
+
+    def loads(self, data):
+        # Only ever load data from a trusted source, such as our own cache_dir.
+        return _LoaderUnpickler(BytesIO(data), self).load()
+
+    def __getitem__(self, key):
+        if not dict.__contains__(self, key) or (self.check_interval is not None and self.is_stale(key)):
+            return self.__missing__(key)
+        with self.lock:
+            tmpl = dict.get(self, key)
+            if tmpl is not None:
+                self.hits += 1
+                if self.maxsize is not None:
+                    self.pop(key)
+                    self[key] = tmpl  # Move to the most recently used end
+        if tmpl is None:  # Invalidated meanwhile
+            return self.__missing__(key)
+        return tmpl
+
     def __missing__(self, key):
-        self[key] = tmpl = self.load(key)
+        """Load a template, ensuring concurrent requests for the same name share a single load."""
+        me = threading.get_ident()
+        with self.lock:
+            future = self.loading.get(key)
+            if future is None:
+                future = self.loading[key] = Future()
+                future.owner = me
+            else:
+                # Waiting on a load which is (indirectly) waiting on us would never finish.
+                owner = future.owner
+                while owner != me and owner in self.waiting:
+                    owner = self.waiting[owner].owner
+                if owner == me:
+                    raise RecursionError(f"Template {key!r} depends on itself")
+                self.waiting[me] = future
+        if future.owner != me:
+            try:
+                return future.result()
+            finally:
+                with self.lock:
+                    del self.waiting[me]
+        try:
+            tmpl = self._load_entry(key)
+        except Exception as exc:
+            future.set_exception(exc)  # Not cached, so the next request tries again
+            raise
+        else:
+            future.set_result(tmpl)
+            return tmpl
+        finally:
+            with self.lock:
+                del self.loading[key]
+
+    def _load_entry(self, key):
+        full_path = self.find(key)
+        stat = full_path.stat()  # Before reading, so a concurrent edit is seen as a change later.
+        tmpl = self.load(key)
+        with self.lock:
+            self.misses += 1
+            previous = self.pop(key, None)
+            for name in getattr(previous, "dependencies", ()):
+                self.dependents[name].discard(key)
+            for name in tmpl.dependencies:
+                self.dependents[name].add(key)
+            self[key] = tmpl
+            self.sources[key] = (full_path, (stat.st_mtime_ns, stat.st_size), time.monotonic())
+            while self.maxsize is not None and len(self) > self.maxsize:
+                oldest = next(iter(self))
+                del self[oldest]
+                self.sources.pop(oldest, None)
+                self.evictions += 1
         return tmpl
 
+    def is_stale(self, key):
+        try:
+            full_path, signature, checked = self.sources[key]
+        except KeyError:
+            return False  # Not loaded from a file
+        now = time.monotonic()
+        if now - checked < self.check_interval:
+            return False
+        try:
+            stat = full_path.stat()
+        except OSError:
+            return True
+        self.sources[key] = (full_path, signature, now)
+        if (stat.st_mtime_ns, stat.st_size) != signature:
+            return True
+        # Templates linked against a parent are also stale when it is.
+        dependencies = getattr(dict.get(self, key), "dependencies", {})
+        return any(self[name] is not tmpl for name, tmpl in dependencies.items())
+
+    def invalidate(self, name):
+        """Remove a template, and every template linked to it, from the cache, returning the names removed."""
+        removed, pending = set(), [name]
+        with self.lock:
+            while pending:
+                name = pending.pop()
+                pending.extend(self.dependents.pop(name, ()))
+                self.sources.pop(name, None)
+                if self.pop(name, None) is not None:
+                    removed.add(name)
+        return removed
+
+    def watch(self, interval=1.0):
+        """Start a watcher which invalidates templates when their files change, preferring InotifyWatcher."""
+        try:
+            watcher = InotifyWatcher(self)
+        except OSError:
+            watcher = PollingWatcher(self, interval)
+        return watcher.start()
+
+    async def get_async(self, key):
+        if dict.__contains__(self, key) and self.check_interval is None:
+            return self[key]
+        return await asyncio.to_thread(self.__getitem__, key)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self), self.maxsize)
+
+    def analyse(self, name):
+        """Return what rendering the template ``name`` may use; see ``Template.analyse()``."""
+        return self[name].analyse()
+
+    def list_templates(self):
+        """Names of all templates found under our paths, skipping hidden files and the cache directory."""
+        names = {}
+        for path in self.paths:
+            for full_path in sorted(path.rglob("*")):
+                name = full_path.relative_to(path).as_posix()
+                if name in names or not full_path.is_file() or any(part.startswith(".") for part in name.split("/")):
+                    continue
+                if self.cache_dir is not None and full_path.is_relative_to(self.cache_dir.resolve()):
+                    continue
+                names[name] = True
+        return list(names)
+
+    def preload(self, names=None, processes=None):
+        """Load templates ahead of time, returning a PreloadResult for each.
+
+        Parse errors are reported, not raised.  With ``processes``, templates are first parsed into the
+        ``cache_dir`` by that many worker processes.
+        """
+        if names is None:
+            names = self.list_templates()
+        parsed = {}
+        if processes is not None:
+            if self.cache_dir is None:
+                raise ValueError("Preloading in several processes needs a cache_dir")
+            worker = partial(_preload_worker, self.paths, self.cache_dir)
+            with ProcessPoolExecutor(processes) as pool:
+                parsed = {result.name: result for result in pool.map(worker, names, chunksize=16)}
+        results = []
+        for name in names:
+            result = parsed.get(name)
+            if result is not None and result.error is not None:
+                results.append(result)
+                continue
+            start = time.perf_counter()
+            try:
+                self[name]
+            except Exception as exc:
+                error = _format_error(exc)
+            else:
+                error = None
+            seconds = time.perf_counter() - start
+            results.append(PreloadResult(name, seconds if result is None else result.seconds + seconds, error))
+        return results
+
+
+def _format_error(exc):
+    return traceback.format_exception_only(exc)[-1].strip()
+
+
+def _preload_worker(paths, cache_dir, name):
+    loader = TemplateLoader(paths, cache_dir=cache_dir)
+    start = time.perf_counter()
+    try:
+        loader.load_cached(loader.find(name).read_text("utf8"), name)
+    except Exception as exc:
+        return PreloadResult(name, time.perf_counter() - start, _format_error(exc))
+    return PreloadResult(name, time.perf_counter() - start, None)
+
+
+class Watcher(ABC):
+    """Invalidates templates in a loader when their files change, from a background thread."""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"stencil-{type(self).__name__}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @abstractmethod
+    def run(self):
+        """Call changed() for each changed file until stopped is set."""
+
+    def changed(self, path):
+        for root in self.loader.paths:
+            if path.is_relative_to(root):
+                self.loader.invalidate(path.relative_to(root).as_posix())
+
+
+class PollingWatcher(Watcher):
+    """Checks the files of loaded templates every ``interval`` seconds."""
+
+    def __init__(self, loader, interval=1.0):
+        super().__init__(loader)
+        self.interval = interval
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for name, (full_path, signature, _checked) in list(self.loader.sources.items()):
+                try:
+                    stat = full_path.stat()
+                except OSError:
+                    stat = None
+                if stat is None or (stat.st_mtime_ns, stat.st_size) != signature:
+                    self.loader.invalidate(name)
+
+
+class InotifyWatcher(Watcher):
+    """Is told of changes by the Linux kernel, using inotify.  Raises OSError where that is not available."""
+
+    IN_MODIFY, IN_ATTRIB, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x4, 0x40, 0x80, 0x100, 0x200
+    IN_ISDIR = 0x40000000
+    EVENTS = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")  # wd, mask, cookie, length of name
+
+    def __init__(self, loader):
+        super().__init__(loader)
+        libc = ctypes.util.find_library("c") if sys.platform.startswith("linux") else None
+        if libc is None:
+            raise OSError("inotify is not available")
+        self.libc = ctypes.CDLL(libc, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # watch descriptor: directory
+        for root in loader.paths:
+            self.add_tree(root)
+
+    def add_tree(self, directory):
+        for path, _dirs, _files in os.walk(directory):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.EVENTS)
+            if wd >= 0:
+                self.watches[wd] = Path(path)
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                if select.select([self.fd], [], [], 0.2)[0]:
+                    self.read_events()
+        finally:
+            os.close(self.fd)
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / os.fsdecode(name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.add_tree(path)
+            else:
+                self.changed(path)
+
+
+class FragmentCache:
+    """Storage for the output of {% cache %} tags.
+
+    Subclasses implement ``get``, returning ``(text, expires)`` or None, ``set``, ``delete`` and ``clear``.
+    ``expires`` is a ``time.time()`` value, or None for never.
+    """
+
+    def __init__(self):
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+        self.loading = {}  # key: Future, for fragments being rendered
+
+    def fresh(self, key):
+        """Return (text if present and not expired, the entry)."""
+        entry = self.get(key)
+        fresh = entry is not None and (entry[1] is None or entry[1] > time.time())
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return (entry[0] if fresh else None), entry
+
+    def fetch(self, key, timeout, render):
+        """Return the text cached for key, calling ``render()`` to produce it if missing or expired.
+
+        Only one thread renders each key at a time.  The others are given the expired text if there is some, otherwise
+        they wait for the result.
+        """
+        text, entry = self.fresh(key)
+        if text is not None:
+            return text
+        me = threading.get_ident()
+        with self.lock:
+            future = self.loading.get(key)
+            leader = future is None
+            if leader:
+                future = self.loading[key] = Future()
+                future.owner = me
+        if not leader:
+            if future.owner == me:  # The same key, nested inside its own fragment
+                return render()
+            return entry[0] if entry is not None else future.result()
+        try:
+            # With nothing to fall back on, there is no point waiting on other processes.
+            claimed = entry is not None and self.claim(key)
+            if entry is not None and not claimed:
+                text = entry[0]  # Being rendered elsewhere, e.g. by another process
+            else:
+                try:
+                    text = render()
+                    self.set(key, text, None if timeout is None else time.time() + timeout)
+                finally:
+                    if claimed:
+                        self.release(key)
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(text)
+            return text
+        finally:
+            with self.lock:
+                del self.loading[key]
+
+    def claim(self, key):  # noqa: ARG002
+        """Claim the right to render an expired key, for backends shared between processes."""
+        return True
+
+    def release(self, key):
+        pass
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self), getattr(self, "maxsize", None))
+
+
+class LocalCache(FragmentCache):
+    """Keep fragments in this process, evicting the least recently used beyond ``maxsize``."""
+
+    def __init__(self, maxsize=1024):
+        super().__init__()
+        self.maxsize = maxsize
+        self.entries = {}
+
+    def __reduce__(self):
+        return type(self), (self.maxsize,)  # An empty cache in each process
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry  # Move to the most recently used end
+            return entry
+
+    def set(self, key, text, expires):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (text, expires)
+            while self.maxsize is not None and len(self.entries) > self.maxsize:
+                del self.entries[next(iter(self.entries))]
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FileCache(FragmentCache):
+    """Keep fragments as files in ``directory``, so they are shared by every process using it.
+
+    An expired fragment is re-rendered by only one process, while the others use the expired text.  Claims older than
+    ``lock_timeout`` seconds are assumed to be abandoned.
+    """
+
+    def __init__(self, directory, lock_timeout=60):
+        super().__init__()
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock_timeout = lock_timeout
+
+    def __reduce__(self):
+        return type(self), (self.directory, self.lock_timeout)
+
+    def __len__(self):
+        return sum(1 for _ in self.directory.glob("*.fragment"))
+
+    def path(self, key, suffix=".fragment"):
+        return self.directory / (hashlib.sha256(key.encode()).hexdigest() + suffix)
+
+    def get(self, key):
+        try:
+            data = self.path(key).read_bytes()
+        except OSError:
+            return None
+        expires, _, text = data.partition(b"\n")
+        try:
+            return text.decode(), (float(expires) if expires else None)
+        except ValueError:  # A damaged file is just a cache miss
+            return None
+
+    def set(self, key, text, expires):
+        header = b"" if expires is None else repr(expires).encode()
+        fout = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as fout:
+                fout.write(header + b"\n" + text.encode())
+            os.replace(fout.name, self.path(key))
+        except BaseException:
+            if fout is not None:
+                Path(fout.name).unlink(missing_ok=True)
+            raise
+
+    def claim(self, key):
+        lock = self.path(key, ".lock")
+        for _ in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                try:
+                    if time.time() - lock.stat().st_mtime < self.lock_timeout:
+                        return False
+                    lock.unlink()
+                except FileNotFoundError:
+                    pass
+            else:
+                return True
+        return False
+
+    def release(self, key):
+        self.path(key, ".lock").unlink(missing_ok=True)
+
+    def delete(self, key):
+        self.path(key).unlink(missing_ok=True)
+
+    def clear(self):
+        for path in self.directory.glob("*.fragment"):
+            path.unlink(missing_ok=True)
+
 
 class Context(ChainMap):
     def __init__(self, *args, escape=html.escape):
         super().__init__(*args)
-        self.maps.append({"True": True, "False": False, "None": None})
+        self.maps.append(dict(CONSTANTS))
         self.escape = escape
+        # All state for a render lives on its Context, never on the (shared) Template.
+        self.block_context = None
+        self.evaluated = {}  # Values of Lazy and awaitable context values, for this render
 
     def push(self, data=None):
         self.maps.insert(0, data or {})
         return self
 
+    def new_child(self, m=None):
+        child = type(self)(m or {}, *self.maps[:-1], escape=self.escape)
+        child.evaluated = self.evaluated
+        return child
+
     def __enter__(self):
         return self
 
@@ -73,11 +799,265 @@ class Context(ChainMap):
         self.maps.pop(0)
 
 
+class FlatContext(dict):
+    """A Context holding only the current value of each name, so lookups are a single dict access.
+
+    Each scope records the values it replaced, which are restored when it is exited.
+    """
+
+    def __init__(self, *args, escape=html.escape):
+        super().__init__(CONSTANTS)
+        for data in reversed(args):
+            super().update(data)
+        self.escape = escape
+        self.scopes = [{}]
+        self.block_context = None
+        self.evaluated = {}
+
+    def push(self, data=None):
+        self.scopes.append({})
+        if data:
+            self.update(data)
+        return self
+
+    def new_child(self, m=None):
+        child = type(self)(self, escape=self.escape)
+        child.evaluated = self.evaluated
+        if m:
+            dict.update(child, m)
+        return child
+
+    def __setitem__(self, key, value):
+        saved = self.scopes[-1]
+        if key not in saved:
+            saved[key] = self.get(key, MISSING)
+        super().__setitem__(key, value)
+
+    def update(self, data=(), **kwargs):
+        for key, value in dict(data, **kwargs).items():
+            self[key] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for key, value in self.scopes.pop().items():
+            if value is MISSING:
+                super().__delitem__(key)
+            else:
+                super().__setitem__(key, value)
+
+
+class Lazy:
+    """A context value computed by calling ``func()`` when it is first used, at most once for each render.
+
+    With ``shared``, it is computed at most once in all, under a lock, and the value used by every render.
+    """
+
+    def __init__(self, func, shared=False):
+        self.func, self.shared = func, shared
+        self.value, self.lock = MISSING, threading.Lock()
+
+    def evaluate(self, context):
+        if self.shared:
+            if self.value is MISSING:
+                with self.lock:
+                    if self.value is MISSING:
+                        self.value = self.func()
+            return self.value
+        evaluated = context.evaluated
+        value = evaluated.get(self, MISSING)
+        if value is MISSING:
+            value = evaluated[self] = self.func()
+        return value
+
+    async def evaluate_async(self, context):
+        if self.shared:
+            return self.evaluate(context)
+        # Keep the awaited result, as a coroutine can only be awaited once.
+        evaluated = context.evaluated
+        value = evaluated.get(self, MISSING)
+        if value is MISSING:
+            value = evaluated[self] = await maybe_await(self.func())
+        return value
+
+    def __getstate__(self):
+        return {**self.__dict__, "lock": None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock=threading.Lock())
+
+
+def make_context(context):
+    if isinstance(context, Context | FlatContext):
+        return context
+    return Context(context)
+
+
+class CodeGen:
+    # CPython refuses to compile more than 20 nested loop/with blocks in one function.
+    MAX_BLOCKS = 16
+
+    def __init__(self):
+        self.lines, self.namespace = [], {"Lazy": Lazy}
+        self.depth, self.blocks, self.counter = 1, 0, 0
+
+    def const(self, value):
+        name = f"_c{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def tmp(self, prefix):
+        self.counter += 1
+        return f"_{prefix}{self.counter}"
+
+    def emit(self, line):
+        self.lines.append("    " * self.depth + line)
+
+    @contextmanager
+    def indent(self, block=False):
+        self.depth += 1
+        self.blocks += block
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            self.blocks -= block
+
+    def build(self, name=None):
+        source = "\n".join(
+            [
+                "def render(context, output):",
+                "    write, escape, lookup = output.write, context.escape, context.get",
+                *self.lines,
+            ]
+        )
+        code = compile(source, f"<stencil {name or 'template'}>", "exec")
+        exec(code, self.namespace)  # noqa: S102
+        return self.namespace["render"]
+
+
+class Analyser:
+    """Gathers what a template reads from its context, passed to each node's ``analyse`` method.
+
+    Paths are written as in templates, with ``[]`` for each item of a sequence a ``for`` tag loops over.
+    """
+
+    def __init__(self, loader=None):
+        self.loader = loader
+        self.variables, self.paths, self.locals, self.templates = set(), set(), set(), set()
+        self.scopes, self.stack = [{}], []
+
+    def result(self):
+        return Analysis(self.variables, self.paths, self.locals, self.templates)
+
+    @contextmanager
+    def scope(self, names):
+        """Bind ``names``, mapping each to the path of its value, or None, within the block."""
+        self.locals.update(names)
+        self.scopes.append(names)
+        try:
+            yield
+        finally:
+            self.scopes.pop()
+
+    def lookup(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        if name in CONSTANTS:
+            return None
+        self.variables.add(name)
+        return name
+
+    def read(self, expr):
+        """Record an expression being evaluated, returning the path it reads, if known."""
+        path = expr.analyse(self) if hasattr(expr, "analyse") else None
+        if path is not None:
+            self.paths.add(path)
+        return path
+
+    def nodelist(self, nodelist):
+        for node in nodelist:
+            node.analyse(self)
+
+    def include(self, name):
+        self.templates.add(name)
+        if self.loader is not None:
+            self.template(self.loader[name])
+
+    def template(self, tmpl):
+        if id(tmpl) in self.stack:
+            return  # Includes itself
+        self.stack.append(id(tmpl))
+        # Parents merged into a linked template are only known from its dependencies.
+        pending = [tmpl]
+        while pending:
+            for name, dependency in pending.pop().dependencies.items():
+                if name not in self.templates:
+                    self.templates.add(name)
+                    pending.append(dependency)
+        self.nodelist(tmpl.nodelist)
+        self.stack.pop()
+
+
 class Nodelist(list):
     def render(self, context, output):
         for node in self:
             node.render(context, output)
 
+    def stream(self, context):
+        for node in self:
+            yield from node.stream(context)
+
+    def optimise(self):
+        nodelist, text, origin = Nodelist(), [], None
+        for node in self:
+            optimised = node.optimise()
+            for child in optimised if isinstance(optimised, Nodelist) else [optimised]:
+                if child.origin is None:
+                    child.origin = node.origin
+                if type(child) is TextTag:
+                    origin = origin if text else child.origin
+                    text.append(child.content)
+                    continue
+                if text:
+                    nodelist.append(TextTag.merged(text, origin))
+                    text = []
+                nodelist.append(child)
+        if text:
+            nodelist.append(TextTag.merged(text, origin))
+        return nodelist
+
+    def is_static(self):
+        return all(type(node) is TextTag for node in self)
+
+    async def astream(self, context):
+        for node in self:
+            async for chunk in node.astream(context):
+                yield chunk
+
+    def compile(self, name=None):
+        gen = CodeGen()
+        self.codegen(gen)
+        self.render = gen.build(name)
+        return self.render
+
+    def codegen(self, gen):
+        if gen.blocks >= CodeGen.MAX_BLOCKS:
+            self.compile()
+            gen.emit(f"{gen.const(self)}.render(context, output)")
+            return
+        if not self:
+            gen.emit("pass")
+        for node in self:
+            node.codegen(gen)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("render", None)
+        return state
+
     def nodes_by_type(self, node_type):
         for node in self:
             if isinstance(node, node_type):
@@ -87,22 +1067,67 @@ class Nodelist(list):
 
 
 class Template:
-    def __init__(self, src, loader=None, name=None):
+    def __init__(self, src, loader=None, name=None, compiled=False, optimise=True):
         self.tokens, self.loader = tokenise(src), loader
         self.name = name  # So we can report where the fault was
         self.nodelist = self.parse_nodelist([])
+        if optimise:
+            self.nodelist = self.nodelist.optimise()
+        # Blocks available to templates extending this one, and the nodelist they are rendered into.
+        self.blocks = None if self.extends else self.find_blocks(self.nodelist)
+        self.base = None if self.extends else self.nodelist
+        self.dependencies = {}
+        self.fragments = {}  # (block name, scoped): node to render, for render_block()
+        self.compiled = False
+        if compiled:
+            self.compile()
+
+    @property
+    def extends(self):
+        if self.nodelist and self.nodelist[0].name == "extends":
+            return self.nodelist[0]
+        return None
+
+    @staticmethod
+    def find_blocks(nodelist):
+        blocks = {}
+        for block in nodelist.nodes_by_type(BlockTag):
+            blocks.setdefault(block.block_name, []).append(block)
+        return blocks
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["tokens"] = None
+        state["fragments"] = {}
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault("fragments", {})
+        self.__dict__.update(state)
+        if self.compiled:
+            self.compile()
+
+    def compile(self):
+        self.nodelist.compile(self.name)
+        self.compiled = True
+        return self
 
     def parse(self):
         for tok in self.tokens:
             if tok.type == TOK_TEXT:
-                yield TextTag(tok.content)
+                node, source = TextTag(tok.content), "text"
             elif tok.type == TOK_VAR:
-                yield VarTag(tok.content)
+                node, source = VarTag(tok.content), f"{{{{ {tok.content} }}}}"
             elif tok.type == TOK_BLOCK:
                 match = re.match(r"\w+", tok.content)
                 if not match:
                     raise SyntaxError(tok)
-                yield BlockNode.__tags__[match.group(0)].parse(tok.content[match.end(0) :].strip(), self)
+                source = f"{{% {tok.content} %}}"
+                node = BlockNode.__tags__[match.group(0)].parse(tok.content[match.end(0) :].strip(), self)
+            else:
+                continue
+            node.origin = (self.name, tok.line, source)
+            yield node
 
     def parse_nodelist(self, ends):
         nodelist = Nodelist()
@@ -117,8 +1142,7 @@ class Template:
         return nodelist
 
     def render(self, context, output=None):
-        if not isinstance(context, Context):
-            context = Context(context)
+        context = make_context(context)
         if output is None:
             dest = StringIO()
         else:
@@ -127,20 +1151,228 @@ class Template:
         if output is None:
             return dest.getvalue()
 
+    def analyse(self):
+        """Return an ``Analysis`` of the context values, and templates, rendering this template may use.
+
+        ``variables`` are the names read from the context, ``paths`` the attributes and keys read from them, and
+        ``locals`` the names bound by tags.  ``templates`` are those extended or included by name, which are followed.
+        """
+        analyser = Analyser(self.loader)
+        analyser.template(self)
+        return analyser.result()
+
+    def renderer(self, escape=html.escape):
+        """Return a function rendering this template with given data, reusing one Context for every call."""
+        context = Context(escape=escape)
+
+        def render(data, output=None):
+            if isinstance(data, Context | FlatContext):
+                return self.render(data, output)
+            context.maps[:-1] = [data]
+            context.block_context, context.evaluated = None, {}
+            return self.render(context, output)
+
+        return render
+
+    def render_many(  # noqa: PLR0913 - options are given by keyword
+        self, contexts, outputs=None, *, escape=html.escape, threads=None, processes=None, chunksize=64
+    ):
+        """Render once for each of ``contexts``, yielding the results in order.
+
+        If ``outputs`` is given, each result is written to the next of them, which is yielded instead.  With
+        ``threads`` or ``processes``, renders are shared between that many workers, in batches of ``chunksize``.
+        Each worker process is sent the template once.
+        """
+        if threads is None and processes is None:
+            render = self.renderer(escape)
+            if outputs is None:
+                yield from map(render, contexts)
+            else:
+                for data, output in zip(contexts, outputs):
+                    render(data, output)
+                    yield output
+            return
+
+        if processes is not None:
+            pool = ProcessPoolExecutor(
+                processes, initializer=_start_render_worker, initargs=(pickle.dumps(self), escape)
+            )
+            work, workers = _render_batch, processes
+        else:
+            pool, workers, local = ThreadPoolExecutor(threads), threads, threading.local()
+
+            def work(batch):
+                if not hasattr(local, "render"):
+                    local.render = self.renderer(escape)
+                return [local.render(data) for data in batch]
+
+        try:
+            results = _map_batches(pool, work, contexts, chunksize, window=2 * workers)
+            if outputs is None:
+                yield from results
+            else:
+                for result, output in zip(results, outputs):
+                    output.write(result)
+                    yield output
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def render_block(self, name, context, output=None, scoped=False):
+        """Render only the block ``name``, as it would be rendered within the whole template.
+
+        With ``scoped``, the ``with`` and ``for`` tags enclosing the block are rendered around it too.
+        """
+        context = make_context(context)
+        node = self.fragments.get((name, scoped))
+        if node is None:
+            path = self.find_block(name, context)
+            if path is None:
+                raise LookupError(f"No block named {name!r}")
+            node = path[-1][0]
+            if scoped:
+                # Enclose it in copies of those tags, holding nothing else.
+                for parent, attr in reversed(path[:-1]):
+                    if isinstance(parent, WithTag | ForTag):
+                        scope = copy.copy(parent)
+                        for child_attr in scope.child_nodelists:
+                            setattr(scope, child_attr, Nodelist())
+                        setattr(scope, attr, Nodelist([node]))
+                        node = scope
+            if self.extends is None:  # Otherwise, the path depends on the context
+                self.fragments[name, scoped] = node
+        dest = StringIO() if output is None else output
+        node.render(context, dest)
+        if output is None:
+            return dest.getvalue()
+
+    def find_block(self, name, context):
+        """Return the [(node, attribute of its nodelist), ...] leading to the block ``name`` as rendered in context."""
+        tmpl = self
+        while tmpl.extends is not None:
+            tmpl = tmpl.extends.get_parent(context)
+
+        def search(nodelist, path):
+            for node in nodelist:
+                if isinstance(node, BlockTag):
+                    if node.block_name == name:
+                        return [*path, (node, None)]
+                    children = [(None, node.get_blocks(context)[0].nodelist)]  # The override rendered
+                else:
+                    children = [(attr, getattr(node, attr, None)) for attr in getattr(node, "child_nodelists", ())]
+                for attr, child in children:
+                    if child and (found := search(child, [*path, (node, attr)])):
+                        return found
+            return None
+
+        return search(tmpl.nodelist, [])
+
+    def render_bytes(self, context, output=None, encoding="utf-8", flush_size=65536):
+        """Render to encoded bytes, returned or written to a binary ``output`` (see ByteSink)."""
+        sink = output if isinstance(output, ByteSink) else ByteSink(output, encoding, flush_size)
+        self.render(context, sink)
+        if output is None:
+            return sink.getvalue()
+        sink.flush()
+
+    def stream(self, context, chunk_size=8192):
+        context = make_context(context)
+        chunks, size = [], 0
+        for chunk in self.nodelist.stream(context):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                yield "".join(chunks)
+                chunks, size = [], 0
+        if chunks:
+            yield "".join(chunks)
+
+    async def render_async(self, context, output=None):
+        context = make_context(context)
+        dest = [] if output is None else output
+        write = dest.append if output is None else dest.write
+        async for chunk in self.nodelist.astream(context):
+            write(chunk)
+        if output is None:
+            return "".join(dest)
+
+    async def stream_async(self, context, chunk_size=8192):
+        context = make_context(context)
+        chunks, size = [], 0
+        async for chunk in self.nodelist.astream(context):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                yield "".join(chunks)
+                chunks, size = [], 0
+        if chunks:
+            yield "".join(chunks)
+
+
+async def maybe_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def await_once(value, context):
+    """Await a context value, keeping the result for the rest of the render, as it can only be awaited once."""
+    if not inspect.isawaitable(value):
+        return value
+    evaluated = context.evaluated
+    entry = evaluated.get(id(value))
+    if entry is None:
+        # Hold the awaitable too, so its id can't be reused during the render.
+        entry = evaluated[id(value)] = (value, await value)
+    return entry[1]
+
 
 class AstUnary:
     def __init__(self, arg):
         self.arg = arg
 
 
+def constant_value(expr):
+    """Return the value of an expression which doesn't depend on the context, or MISSING."""
+    # Not True, False or None, which the context may override.
+    if isinstance(expr, AstLiteral):
+        return expr.arg
+    return MISSING
+
+
 class AstLiteral(AstUnary):
     def resolve(self, _context):
         return self.arg
 
+    async def resolve_async(self, _context):
+        return self.arg
+
+    def analyse(self, _analyser):
+        return None
+
+    def codegen(self, gen):
+        if type(self.arg) in (str, int):
+            return repr(self.arg)
+        return gen.const(self.arg)
+
 
 class AstContext(AstUnary):
     def resolve(self, context):
-        return context.get(self.arg, "")
+        value = context.get(self.arg, "")
+        if type(value) is Lazy:
+            return value.evaluate(context)
+        return value
+
+    async def resolve_async(self, context):
+        value = context.get(self.arg, "")
+        if type(value) is Lazy:
+            return await value.evaluate_async(context)
+        return await await_once(value, context)
+
+    def analyse(self, analyser):
+        return analyser.lookup(self.arg)
+
+    def codegen(self, _gen):
+        return f"(_lazy.evaluate(context) if type(_lazy := lookup({self.arg!r}, '')) is Lazy else _lazy)"
 
 
 class AstBinary:
@@ -156,6 +1388,19 @@ class AstLookup(AstBinary):
 
         return left[right]
 
+    async def resolve_async(self, context):
+        left = await self.left.resolve_async(context)
+        right = await self.right.resolve_async(context)
+
+        return await maybe_await(left[right])
+
+    def analyse(self, analyser):
+        analyser.read(self.left)
+        analyser.read(self.right)
+
+    def codegen(self, gen):
+        return f"{codegen_expr(self.left, gen)}[{codegen_expr(self.right, gen)}]"
+
 
 class AstAttr(AstBinary):
     def resolve(self, context):
@@ -163,6 +1408,97 @@ class AstAttr(AstBinary):
 
         return getattr(left, self.right, "")
 
+    async def resolve_async(self, context):
+        left = await self.left.resolve_async(context)
+
+        return await maybe_await(getattr(left, self.right, ""))
+
+    def analyse(self, analyser):
+        path = self.left.analyse(analyser)
+        return None if path is None else f"{path}.{self.right}"
+
+    def codegen(self, gen):
+        return f"getattr({codegen_expr(self.left, gen)}, {self.right!r}, '')"
+
+
+class AstChain:
+    """A run of attribute and constant key lookups, such as ``user.profile["address"].city``, resolved in one step.
+
+    ``steps`` holds ``(True, name)`` for each attribute and ``(False, key)`` for each key.  Consecutive attributes are
+    fetched with one ``attrgetter``.  If one is missing, the value is walked again a step at a time so it resolves to
+    ``""`` as with ``AstAttr``, and the type of the value is remembered so it is always walked that way.
+    """
+
+    MAX_TYPES = 64
+
+    def __init__(self, root, steps):
+        self.root, self.steps = root, steps
+        self.name = root.arg if type(root) is AstContext else None
+        self.getters = []
+        for is_attr, run in groupby(steps, key=itemgetter(0)):
+            keys = [key for _, key in run]
+            if is_attr:
+                self.getters.append(attrgetter(".".join(keys)))
+            else:
+                self.getters.extend(itemgetter(key) for key in keys)
+        self.get = self.getters[0] if len(self.getters) == 1 else self.get_all
+        self.walked = set()  # Types of values which are missing attributes
+
+    @classmethod
+    def extend(cls, expr, step):
+        if isinstance(expr, cls):
+            return cls(expr.root, (*expr.steps, step))
+        return cls(expr, (step,))
+
+    def get_all(self, value):
+        for get in self.getters:
+            value = get(value)
+        return value
+
+    def walk(self, value):
+        for is_attr, key in self.steps:
+            value = getattr(value, key, "") if is_attr else value[key]
+        return value
+
+    def resolve(self, context):
+        if self.name is None:
+            value = self.root.resolve(context)
+        elif type(value := context.get(self.name, "")) is Lazy:
+            value = value.evaluate(context)
+        if type(value) not in self.walked:
+            try:
+                return self.get(value)
+            except AttributeError:
+                if len(self.walked) < self.MAX_TYPES:
+                    self.walked.add(type(value))
+        return self.walk(value)
+
+    async def resolve_async(self, context):
+        value = await self.root.resolve_async(context)
+        for is_attr, key in self.steps:
+            value = await maybe_await(getattr(value, key, "") if is_attr else value[key])
+        return value
+
+    def analyse(self, analyser):
+        path = self.root.analyse(analyser)
+        if path is None:
+            return None
+        return path + "".join(f".{key}" if is_attr else f"[{key!r}]" for is_attr, key in self.steps)
+
+    def codegen(self, gen):
+        code = codegen_expr(self.root, gen)
+        for is_attr, key in self.steps:
+            arg = repr(key) if type(key) in (str, int) else gen.const(key)
+            code = f"getattr({code}, {arg}, '')" if is_attr else f"{code}[{arg}]"
+        return code
+
+    def __getstate__(self):
+        # Remembered types may not be picklable, and are cheap to find again.
+        return {"root": self.root, "steps": self.steps}
+
+    def __setstate__(self, state):
+        self.__init__(state["root"], state["steps"])
+
 
 class AstCall:
     def __init__(self, func):
@@ -178,10 +1514,79 @@ class AstCall:
 
         return func(*args)
 
+    async def resolve_async(self, context):
+        func = await self.func.resolve_async(context)
+        args = [await arg.resolve_async(context) for arg in self.args]
+
+        return await maybe_await(func(*args))
+
+    def analyse(self, analyser):
+        analyser.read(self.func)
+        for arg in self.args:
+            analyser.read(arg)
+
+    def codegen(self, gen):
+        args = ", ".join(codegen_expr(arg, gen) for arg in self.args)
+        return f"{codegen_expr(self.func, gen)}({args})"
+
+
+def codegen_expr(expr, gen):
+    if hasattr(expr, "codegen"):
+        return expr.codegen(gen)
+    return f"{gen.const(expr)}.resolve(context)"
+
+
+def resolve_kwargs(kwargs, context):
+    # Names are bound as they are, so lazy values are only evaluated if used.
+    return {
+        key: context.get(expr.arg, "") if type(expr) is AstContext else expr.resolve(context)
+        for key, expr in kwargs.items()
+    }
+
+
+async def resolve_kwargs_async(kwargs, context):
+    values = {}
+    for key, expr in kwargs.items():
+        if type(expr) is AstContext:
+            values[key] = await await_once(context.get(expr.arg, ""), context)
+        else:
+            values[key] = await expr.resolve_async(context)
+    return values
+
+
+def codegen_kwargs(kwargs, gen):
+    return ", ".join(
+        f"{key!r}: lookup({expr.arg!r}, '')" if type(expr) is AstContext else f"{key!r}: {codegen_expr(expr, gen)}"
+        for key, expr in kwargs.items()
+    )
+
+
+expr_re = re.compile(
+    r"""\s*(?:
+    (?P<number>(?:\d(?:_?\d)*(?:\.(?:\d(?:_?\d)*)?)?|\.\d(?:_?\d)*)(?:[eE][-+]?\d(?:_?\d)*)?)
+    |(?P<name>[^\W\d]\w*)
+    |(?P<string>'[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*")
+    |(?P<op>[][().,=])
+    |(?P<error>\S)
+    )""",
+    re.VERBOSE,
+)
+ExprToken = namedtuple("ExprToken", "exact_type string start line")
+EXPR_TOKEN_TYPES = {"number": token.NUMBER, "name": token.NAME, "string": token.STRING, "error": token.ERRORTOKEN}
+
+
+def tokenise_expression(source):
+    for match in expr_re.finditer(source):
+        kind = match.lastgroup
+        value = match[kind]
+        tok_type = token.EXACT_TOKEN_TYPES[value] if kind == "op" else EXPR_TOKEN_TYPES[kind]
+        yield ExprToken(tok_type, value, match.start(kind), source)
+    yield ExprToken(token.ENDMARKER, "", len(source), source)
+
 
 class Expression:
     def __init__(self, source):
-        self.tokens = tokenize.generate_tokens(StringIO(source).readline)
+        self.tokens = tokenise_expression(source)
         self.next()  # prime the first token
 
     def next(self):
@@ -189,11 +1594,13 @@ class Expression:
         return self.current
 
     @staticmethod
+    @lru_cache(maxsize=4096)
     def parse(src):
+        # Expressions are immutable once parsed, so are safely shared between nodes.
         parser = Expression(src)
         result = parser._parse()
 
-        if parser.current.exact_type not in (token.NEWLINE, token.ENDMARKER):
+        if parser.current.exact_type != token.ENDMARKER:
             raise SyntaxError(f"Parse ended unexpectedly: {parser.current}")
 
         return result
@@ -204,7 +1611,7 @@ class Expression:
         tok = self.current
 
         while tok.exact_type != token.ENDMARKER:
-            if tok.exact_type == token.NEWLINE:
+            if tok.exact_type == token.COMMA:
                 tok = self.next()
                 continue
 
@@ -219,10 +1626,19 @@ class Expression:
 
             kwargs[name] = self._parse()
 
-            tok = self.next()
+            tok = self.current
 
         return kwargs
 
+    def parse_subscript(self, state):
+        self.next()
+        right = self._parse()
+        if self.current.exact_type != token.RSQB:
+            raise SyntaxError(f"Expected ] but found {self.current}")
+        if isinstance(right, AstLiteral):
+            return AstChain.extend(state, (False, right.arg))
+        return AstLookup(state, right)
+
     def parse_expression(self, tok):
         state = AstContext(tok.string)
 
@@ -234,14 +1650,10 @@ class Expression:
                     tok = self.next()
                     if tok.exact_type != token.NAME:
                         raise SyntaxError(f"Invalid attr lookup: {tok}")
-                    state = AstAttr(state, tok.string)
+                    state = AstChain.extend(state, (True, tok.string))
 
                 case token.LSQB:
-                    self.next()
-                    right = self._parse()
-                    state = AstLookup(state, right)
-                    if self.current.exact_type != token.RSQB:
-                        raise SyntaxError(f"Expected ] but found {self.current}")
+                    state = self.parse_subscript(state)
 
                 case token.LPAR:
                     state = AstCall(state)
@@ -284,12 +1696,14 @@ class Expression:
                 return self.parse_expression(tok)
 
         raise SyntaxError(
-            f"Error parsing expression {tok.line !r}: Unexpected token {tok.string!r} at position {tok.start[0]}."
+            f"Error parsing expression {tok.line !r}: Unexpected token {tok.string!r} at position {tok.start}."
         )
 
 
 class Node:
     name = None
+    # (template name, line, source) this node was parsed from, if known
+    origin = None
 
     def __init__(self, content):
         self.content = content
@@ -297,21 +1711,75 @@ class Node:
     def render(self, context, output):
         pass
 
+    def stream(self, context):
+        output = StringIO()
+        self.render(context, output)
+        if value := output.getvalue():
+            yield value
+
+    def optimise(self):
+        return self
+
+    def analyse(self, analyser):
+        pass
+
+    def prerender(self):
+        output = StringIO()
+        try:
+            self.render(Context(), output)
+        except Exception:  # Leave errors to be raised when, if ever, the node is rendered
+            return self
+        return TextTag(output.getvalue())
+
+    async def astream(self, context):
+        for chunk in self.stream(context):
+            yield chunk
+
+    def codegen(self, gen):
+        gen.emit(f"{gen.const(self)}.render(context, output)")
+
 
 class TextTag(Node):
+    def __init__(self, content):
+        self.content = Text(content)
+
+    @classmethod
+    def merged(cls, text, origin):
+        node = cls("".join(text))
+        node.origin = origin
+        return node
+
     def render(self, _context, output):
         output.write(self.content)
 
+    def stream(self, _context):
+        yield self.content
+
+    async def astream(self, _context):
+        yield self.content
+
+    def codegen(self, gen):
+        gen.emit(f"write({gen.const(self.content)})")
+
 
 class VarTag(Node):
     def __init__(self, content):
         self.expr = Expression.parse(content)
 
     def render(self, context, output):
-        value = str(self.expr.resolve(context))
-        if not getattr(value, "__safe__", False):
-            value = context.escape(value)
-        output.write(value)
+        output.write(format_value(self.expr.resolve(context), context.escape))
+
+    def stream(self, context):
+        yield format_value(self.expr.resolve(context), context.escape)
+
+    async def astream(self, context):
+        yield format_value(await self.expr.resolve_async(context), context.escape)
+
+    def analyse(self, analyser):
+        analyser.read(self.expr)
+
+    def codegen(self, gen):
+        gen.emit(f"write({gen.const(format_value)}({codegen_expr(self.expr, gen)}, escape))")
 
 
 class BlockNode(Node):
@@ -334,12 +1802,122 @@ class BlockNode(Node):
             if nodelist:
                 yield from nodelist.nodes_by_type(node_type)
 
+    def optimise(self):
+        for attr in self.child_nodelists:
+            nodelist = getattr(self, attr, None)
+            if nodelist:
+                setattr(self, attr, nodelist.optimise())
+        return self
+
+    def analyse(self, analyser):
+        for attr in self.child_nodelists:
+            nodelist = getattr(self, attr, None)
+            if nodelist:
+                analyser.nodelist(nodelist)
+
+    def codegen(self, gen):
+        # No codegen hook: compile the children, and let the interpreter drive this node.
+        for attr in self.child_nodelists:
+            nodelist = getattr(self, attr, None)
+            if nodelist:
+                nodelist.compile()
+        super().codegen(gen)
+
+
+class Loop:
+    """The ``loop`` variable in a for tag.
+
+    Values needing the length only consume an iterator that has no len() when they are used.
+    """
+
+    __slots__ = ("_iterator", "_length", "_rest", "index0")
+
+    def __init__(self, iterable):
+        self.index0, self._rest = 0, ()
+        try:
+            self._length = len(iterable)
+        except TypeError:
+            self._length, self._iterator = None, iter(iterable)
+        else:
+            self._iterator = iterable
+
+    def items(self):
+        if self._length is not None:
+            return self._iterator
+        return self._items()
+
+    def _items(self):
+        yield from self._iterator
+        yield from self._rest  # Anything consumed to find the length
+
+    @property
+    def index(self):
+        return self.index0 + 1
+
+    @property
+    def first(self):
+        return self.index0 == 0
+
+    @property
+    def length(self):
+        if self._length is None:
+            self._rest = list(self._iterator)
+            self._length = self.index0 + 1 + len(self._rest)
+        return self._length
+
+    @property
+    def last(self):
+        return self.index0 == self.length - 1
+
+    @property
+    def revindex(self):
+        return self.length - self.index0
+
+    @property
+    def revindex0(self):
+        return self.length - self.index0 - 1
+
+
+class AsyncLoop(Loop):
+    __slots__ = ()
+
+    def __init__(self, iterable):
+        self.index0, self._rest, self._length, self._iterator = 0, (), None, aiter(iterable)
+
+    async def _items(self):
+        async for item in self._iterator:
+            yield item
+        for item in self._rest:
+            yield item
+
+    @property
+    async def length(self):
+        if self._length is None:
+            self._rest = [item async for item in self._iterator]
+            self._length = self.index0 + 1 + len(self._rest)
+        return self._length
+
+    @property
+    async def last(self):
+        return self.index0 == await self.length - 1
+
+    @property
+    async def revindex(self):
+        return await self.length - self.index0
+
+    @property
+    async def revindex0(self):
+        return await self.length - self.index0 - 1
+
 
 class ForTag(BlockNode, name="for"):
     child_nodelists = ("nodelist", "elselist")
 
     def __init__(self, argname, iterable, nodelist, elselist):
         self.argname, self.iterable, self.nodelist, self.elselist = argname, iterable, nodelist, elselist  # fmt: skip
+        self.argnames = tuple(name.strip() for name in argname.split(","))
+        if not all(name.isidentifier() for name in self.argnames):
+            raise SyntaxError(f"Invalid loop variable: {argname!r}")
 
     @classmethod
     def parse(cls, content, parser):
@@ -348,16 +1926,100 @@ class ForTag(BlockNode, name="for"):
         elselist = parser.parse_nodelist({"endfor"}) if nodelist.endnode.name == "else" else None  # fmt: skip
         return cls(argname.strip(), Expression.parse(iterable.strip()), nodelist, elselist)  # fmt: skip
 
+    def assign(self, context, item):
+        if len(self.argnames) == 1:
+            context[self.argnames[0]] = item
+        else:
+            for name, value in zip(self.argnames, item, strict=True):
+                context[name] = value
+
     def render(self, context, output):
         iterable = self.iterable.resolve(context)
         if iterable:
-            with context.push():
-                for idx, item in enumerate(iterable):
-                    context.update({"loopcounter": idx, self.argname: item})
+            loop = Loop(iterable)
+            with context.push({"loop": loop}):
+                for loop.index0, item in enumerate(loop.items()):
+                    context["loopcounter"] = loop.index0
+                    self.assign(context, item)
                     self.nodelist.render(context, output)
         elif self.elselist:
             self.elselist.render(context, output)
 
+    def stream(self, context):
+        iterable = self.iterable.resolve(context)
+        if iterable:
+            loop = Loop(iterable)
+            with context.push({"loop": loop}):
+                for loop.index0, item in enumerate(loop.items()):
+                    context["loopcounter"] = loop.index0
+                    self.assign(context, item)
+                    yield from self.nodelist.stream(context)
+        elif self.elselist:
+            yield from self.elselist.stream(context)
+
+    def optimise(self):
+        super().optimise()
+        if constant_value(self.iterable) is MISSING or not self.nodelist.is_static():
+            return self
+        if self.elselist and not self.elselist.is_static():
+            return self
+        return self.prerender()
+
+    async def astream(self, context):
+        iterable = await self.iterable.resolve_async(context)
+        empty = True
+        if hasattr(iterable, "__aiter__"):
+            loop = AsyncLoop(iterable)
+            with context.push({"loop": loop}):
+                async for item in loop.items():
+                    empty = False
+                    context["loopcounter"] = loop.index0
+                    self.assign(context, item)
+                    async for chunk in self.nodelist.astream(context):
+                        yield chunk
+                    loop.index0 += 1
+        elif iterable:
+            empty = False
+            loop = Loop(iterable)
+            with context.push({"loop": loop}):
+                for loop.index0, item in enumerate(loop.items()):
+                    context["loopcounter"] = loop.index0
+                    self.assign(context, item)
+                    async for chunk in self.nodelist.astream(context):
+                        yield chunk
+        if empty and self.elselist:
+            async for chunk in self.elselist.astream(context):
+                yield chunk
+
+    def analyse(self, analyser):
+        path = analyser.read(self.iterable)
+        item = None if path is None or len(self.argnames) > 1 else f"{path}[]"
+        with analyser.scope({"loop": None, "loopcounter": None, **dict.fromkeys(self.argnames, item)}):
+            analyser.nodelist(self.nodelist)
+        if self.elselist:
+            analyser.nodelist(self.elselist)
+
+    def codegen(self, gen):
+        iterable, loop = gen.tmp("it"), gen.tmp("loop")
+        gen.emit(f"{iterable} = {codegen_expr(self.iterable, gen)}")
+        gen.emit(f"if {iterable}:")
+        with gen.indent():
+            gen.emit(f"{loop} = {gen.const(Loop)}({iterable})")
+            gen.emit(f"with context.push({{'loop': {loop}}}):")
+            with gen.indent(block=True):
+                # Bind straight from the loop target, unpacking without building any intermediate objects.
+                targets = ", ".join(f"context[{name!r}]" for name in self.argnames)
+                if len(self.argnames) > 1:
+                    targets = f"({targets})"
+                gen.emit(f"for {loop}.index0, {targets} in enumerate({loop}.items()):")
+                with gen.indent(block=True):
+                    gen.emit(f"context['loopcounter'] = {loop}.index0")
+                    self.nodelist.codegen(gen)
+        if self.elselist:
+            gen.emit("else:")
+            with gen.indent():
+                self.elselist.codegen(gen)
+
 
 class ElseTag(BlockNode, name="else"):
     pass
@@ -387,15 +2049,56 @@ class IfTag(BlockNode, name="if"):
         elif self.elselist:
             self.elselist.render(context, output)
 
+    def stream(self, context):
+        if self.test_condition(context):
+            yield from self.nodelist.stream(context)
+        elif self.elselist:
+            yield from self.elselist.stream(context)
+
+    async def astream(self, context):
+        nodelist = self.nodelist if self.inv ^ bool(await self.condition.resolve_async(context)) else self.elselist
+        if nodelist:
+            async for chunk in nodelist.astream(context):
+                yield chunk
+
     def test_condition(self, context):
         return self.inv ^ bool(self.condition.resolve(context))
 
+    def optimise(self):
+        super().optimise()
+        value = constant_value(self.condition)
+        if value is MISSING:
+            return self
+        keep, drop = self.nodelist, self.elselist
+        if not self.inv ^ bool(value):
+            keep, drop = drop, keep
+        # Blocks are found by {% extends %} even in branches which aren't rendered.
+        if drop and any(drop.nodes_by_type(BlockTag)):
+            return self
+        return keep or Nodelist()
+
+    def analyse(self, analyser):
+        analyser.read(self.condition)
+        super().analyse(analyser)
+
+    def codegen(self, gen):
+        gen.emit(f"if {'not ' if self.inv else ''}{codegen_expr(self.condition, gen)}:")
+        with gen.indent():
+            self.nodelist.codegen(gen)
+        if self.elselist:
+            gen.emit("else:")
+            with gen.indent():
+                self.elselist.codegen(gen)
+
 
 class EndifTag(BlockNode, name="endif"):
     pass
 
 
 class IncludeTag(BlockNode, name="include"):
+    # The included template, when it was linked by the loader
+    template = None
+
     def __init__(self, template_name, kwargs, loader):
         self.template_name, self.kwargs, self.loader = template_name, kwargs, loader
 
@@ -409,12 +2112,61 @@ class IncludeTag(BlockNode, name="include"):
         return cls(template_name, kwargs, parser.loader)
 
     def render(self, context, output):
+        if self.template is not None:
+            with context.push(resolve_kwargs(self.kwargs, context)):
+                self.template.nodelist.render(context, output)
+            return
         name = self.template_name.resolve(context)
         tmpl = self.loader[name]
-        kwargs = {key: expr.resolve(context) for key, expr in self.kwargs.items()}
+        kwargs = resolve_kwargs(self.kwargs, context)
         ctx = context.new_child(kwargs)
         tmpl.render(ctx, output)
 
+    def stream(self, context):
+        if self.template is not None:
+            with context.push(resolve_kwargs(self.kwargs, context)):
+                yield from self.template.nodelist.stream(context)
+            return
+        tmpl = self.loader[self.template_name.resolve(context)]
+        kwargs = resolve_kwargs(self.kwargs, context)
+        yield from tmpl.nodelist.stream(context.new_child(kwargs))
+
+    async def astream(self, context):
+        if self.template is not None:
+            kwargs = await resolve_kwargs_async(self.kwargs, context)
+            with context.push(kwargs):
+                async for chunk in self.template.nodelist.astream(context):
+                    yield chunk
+            return
+        tmpl = await self.loader.get_async(await self.template_name.resolve_async(context))
+        kwargs = await resolve_kwargs_async(self.kwargs, context)
+        async for chunk in tmpl.nodelist.astream(context.new_child(kwargs)):
+            yield chunk
+
+    def analyse(self, analyser):
+        kwargs = {key: analyser.read(expr) for key, expr in self.kwargs.items()}
+        name = constant_value(self.template_name)
+        if not isinstance(name, str):
+            analyser.read(self.template_name)
+            return
+        with analyser.scope(kwargs):
+            if self.template is None:
+                analyser.include(name)
+            else:
+                analyser.templates.add(name)
+                analyser.template(self.template)
+
+    def codegen(self, gen):
+        kwargs = codegen_kwargs(self.kwargs, gen)
+        if self.template is not None:
+            gen.emit(f"with context.push({{{kwargs}}}):")
+            with gen.indent(block=True):
+                self.template.nodelist.codegen(gen)
+            return
+        tmpl = gen.tmp("t")
+        gen.emit(f"{tmpl} = {gen.const(self.loader)}[{codegen_expr(self.template_name, gen)}]")
+        gen.emit(f"{tmpl}.render(context.new_child({{{kwargs}}}), output)")
+
 
 class LoadTag(BlockNode, name="load"):
     @classmethod
@@ -422,6 +2174,39 @@ class LoadTag(BlockNode, name="load"):
         importlib.import_module(content)
         return cls(None)
 
+    def optimise(self):
+        return Nodelist()
+
+
+def link_blocks(nodelist, blocks):
+    """Copy a nodelist, with each block tag rendering its most derived override, and ``block.super`` the rest.
+
+    ``blocks`` maps each block name to its overrides, most derived first.
+    """
+    overrides = {name: [] for name in blocks}
+    linked = {}
+
+    def relink(nodelist):
+        if id(nodelist) not in linked:
+            linked[id(nodelist)] = result = Nodelist()
+            result.extend(relink_node(node) for node in nodelist)
+        return linked[id(nodelist)]
+
+    def relink_node(node):
+        if not isinstance(node, BlockNode):
+            return node
+        node = copy.copy(node)
+        for attr in node.child_nodelists:
+            if getattr(node, attr, None):
+                setattr(node, attr, relink(getattr(node, attr)))
+        if isinstance(node, BlockTag):
+            node.overrides = overrides.get(node.block_name, (node,))
+        return node
+
+    for name, raw in blocks.items():
+        overrides[name].extend(relink_node(block) for block in raw)
+    return relink(nodelist)
+
 
 class ExtendsTag(BlockNode, name="extends"):
     def __init__(self, parent, loader, nodelist):
@@ -434,22 +2219,71 @@ class ExtendsTag(BlockNode, name="extends"):
         return cls(parent, parser.loader, nodelist)
 
     def render(self, context, output):
-        parent = self.loader[self.parent.resolve(context)]
-        block_context = getattr(context, "block_context", None)
+        self.get_parent(context).render(context, output)
+
+    def stream(self, context):
+        yield from self.get_parent(context).nodelist.stream(context)
+
+    async def astream(self, context):
+        parent = await self.loader.get_async(await self.parent.resolve_async(context))
+        async for chunk in self.push_blocks(context, parent).nodelist.astream(context):
+            yield chunk
+
+    def get_parent(self, context):
+        return self.push_blocks(context, self.loader[self.parent.resolve(context)])
+
+    def analyse(self, analyser):
+        for block in self.nodelist.nodes_by_type(BlockTag):
+            block.analyse(analyser)
+        name = constant_value(self.parent)
+        if isinstance(name, str):
+            analyser.include(name)
+        else:
+            analyser.read(self.parent)
+
+    def push_blocks(self, context, parent):
+        block_context = context.block_context
         if block_context is None:
             block_context = context.block_context = defaultdict(deque)
         for block in self.nodelist.nodes_by_type(BlockTag):
             block_context[block.block_name].append(block)
-        if parent.nodelist[0].name != "extends":
-            for block in parent.nodelist.nodes_by_type(BlockTag):
-                block_context[block.block_name].append(block)
-        parent.render(context, output)
+        for name, blocks in (parent.blocks or {}).items():
+            block_context[name].extend(blocks)
+        return parent
+
+
+class BlockSuper:
+    """The ``block`` variable within a block, giving access to ``block.super``"""
+
+    def __init__(self, name, parents, context):
+        self.name, self.parents, self.context = name, parents, context
+
+    @property
+    def super(self):
+        if not self.parents:
+            return ""
+        block, *parents = self.parents
+        output = StringIO()
+        with self.context.push({"block": BlockSuper(self.name, parents, self.context)}):
+            block.nodelist.render(self.context, output)
+        return SafeStr(output.getvalue())
+
+
+class AsyncBlockSuper(BlockSuper):
+    @property
+    async def super(self):
+        if not self.parents:
+            return ""
+        block, *parents = self.parents
+        with self.context.push({"block": AsyncBlockSuper(self.name, parents, self.context)}):
+            chunks = [chunk async for chunk in block.nodelist.astream(self.context)]
+        return SafeStr("".join(chunks))
 
 
 class BlockTag(BlockNode, name="block"):
     def __init__(self, name, nodelist):
         self.block_name, self.nodelist = name, nodelist
-        self.context = self.output = None
+        self.overrides = (self,)  # Replaced when the template is linked to those extending it
 
     @classmethod
     def parse(cls, content, parser):
@@ -461,25 +2295,44 @@ class BlockTag(BlockNode, name="block"):
         return cls(name, nodelist)
 
     def render(self, context, output):
-        self.context = context
-        self.output = output
-        self._render()
-
-    def _render(self):
-        block_context = getattr(self.context, "block_context", {})
-        if not block_context:
-            block = self
-        else:
-            block = block_context[self.block_name].popleft()
-        with self.context.push({"block": self}):
-            block.nodelist.render(self.context, self.output)
-        if block_context:
-            block_context[self.block_name].appendleft(block)
-
-    @property
-    def super(self):
-        self._render()
-        return ""
+        block, *parents = self.get_blocks(context)
+        with context.push({"block": BlockSuper(self.block_name, parents, context)}):
+            block.nodelist.render(context, output)
+
+    def stream(self, context):
+        block, *parents = self.get_blocks(context)
+        with context.push({"block": BlockSuper(self.block_name, parents, context)}):
+            yield from block.nodelist.stream(context)
+
+    async def astream(self, context):
+        block, *parents = self.get_blocks(context)
+        with context.push({"block": AsyncBlockSuper(self.block_name, parents, context)}):
+            async for chunk in block.nodelist.astream(context):
+                yield chunk
+
+    def get_blocks(self, context):
+        block_context = context.block_context
+        return block_context[self.block_name] if block_context else self.overrides
+
+    def analyse(self, analyser):
+        # Any override may be rendered, through block.super.
+        with analyser.scope({"block": None}):
+            for block in self.overrides:
+                analyser.nodelist(block.nodelist)
+
+    def codegen(self, gen):
+        for block in self.overrides:
+            if "render" not in vars(block.nodelist):
+                block.nodelist.compile()
+        block, *parents = self.overrides
+        gen.emit("if context.block_context:")
+        gen.emit(f"    {gen.const(self)}.render(context, output)")
+        gen.emit("else:")
+        with gen.indent():
+            block_super = f"{gen.const(BlockSuper)}({self.block_name!r}, {gen.const(parents)}, context)"
+            gen.emit(f"with context.push({{'block': {block_super}}}):")
+            with gen.indent(block=True):
+                block.nodelist.codegen(gen)
 
 
 class EndBlockTag(BlockNode, name="endblock"):
@@ -497,15 +2350,117 @@ class WithTag(BlockNode, name="with"):
         return cls(kwargs, nodelist)
 
     def render(self, context, output):
-        kwargs = {key: value.resolve(context) for key, value in self.kwargs.items()}
+        kwargs = resolve_kwargs(self.kwargs, context)
         with context.push(kwargs):
             self.nodelist.render(context, output)
 
+    def stream(self, context):
+        kwargs = resolve_kwargs(self.kwargs, context)
+        with context.push(kwargs):
+            yield from self.nodelist.stream(context)
+
+    def optimise(self):
+        super().optimise()
+        # Only drop the scope when computing its values can have no side effects.
+        pure = all(isinstance(expr, AstLiteral | AstContext) for expr in self.kwargs.values())
+        if pure and self.nodelist.is_static():
+            return self.nodelist
+        return self
+
+    async def astream(self, context):
+        kwargs = await resolve_kwargs_async(self.kwargs, context)
+        with context.push(kwargs):
+            async for chunk in self.nodelist.astream(context):
+                yield chunk
+
+    def analyse(self, analyser):
+        with analyser.scope({key: analyser.read(expr) for key, expr in self.kwargs.items()}):
+            analyser.nodelist(self.nodelist)
+
+    def codegen(self, gen):
+        kwargs = codegen_kwargs(self.kwargs, gen)
+        gen.emit(f"with context.push({{{kwargs}}}):")
+        with gen.indent(block=True):
+            self.nodelist.codegen(gen)
+
 
 class EndWithTag(BlockNode, name="endwith"):
     pass
 
 
+class CacheTag(BlockNode, name="cache"):
+    # The FragmentCache used when the template's loader has no fragment_cache
+    backend = LocalCache()
+
+    def __init__(self, key, timeout, vary, nodelist, loader):
+        self.key, self.timeout, self.vary, self.nodelist, self.loader = key, timeout, vary, nodelist, loader
+
+    @classmethod
+    def parse(cls, content, parser):
+        tokens = Expression(content)
+        args = []
+        while tokens.current.exact_type != token.ENDMARKER:
+            arg = tokens._parse()
+            if arg is None:
+                raise SyntaxError(f"Expected a value, found {tokens.current.string!r}")
+            args.append(arg)
+        if not args:
+            raise SyntaxError("{% cache %} needs a key")
+        nodelist = parser.parse_nodelist({"endcache"})
+        return cls(args[0], args[1] if len(args) > 1 else None, args[2:], nodelist, parser.loader)
+
+    def optimise(self):
+        super().optimise()
+        pure = all(isinstance(expr, AstLiteral | AstContext) for expr in [self.key, *self.vary])
+        if pure and self.nodelist.is_static():
+            return self.nodelist
+        return self
+
+    def analyse(self, analyser):
+        for expr in [self.key, self.timeout, *self.vary]:
+            analyser.read(expr)
+        analyser.nodelist(self.nodelist)
+
+    def get_backend(self):
+        backend = getattr(self.loader, "fragment_cache", None)
+        return CacheTag.backend if backend is None else backend
+
+    def get_key(self, context):
+        return ":".join(str(expr.resolve(context)) for expr in [self.key, *self.vary])
+
+    def get_timeout(self, context):
+        return None if self.timeout is None else self.timeout.resolve(context)
+
+    def fetch(self, context):
+        def render():
+            output = StringIO()
+            self.nodelist.render(context, output)
+            return output.getvalue()
+
+        return self.get_backend().fetch(self.get_key(context), self.get_timeout(context), render)
+
+    def render(self, context, output):
+        output.write(self.fetch(context))
+
+    def stream(self, context):
+        yield self.fetch(context)
+
+    async def astream(self, context):
+        # Without waiting on renders of the same fragment in other threads.
+        backend = self.get_backend()
+        key = ":".join([str(await expr.resolve_async(context)) for expr in [self.key, *self.vary]])
+        text, _entry = backend.fresh(key)
+        if text is None:
+            text = "".join([chunk async for chunk in self.nodelist.astream(context)])
+            timeout = None if self.timeout is None else await self.timeout.resolve_async(context)
+            backend.set(key, text, None if timeout is None else time.time() + timeout)
+        yield text
+
+
+class EndCacheTag(BlockNode, name="endcache"):
+    pass
+
+
 class CaseTag(BlockNode, name="case"):
     def __init__(self, term, nodelist):
         self.term, self.nodelist = term, nodelist
@@ -536,6 +2491,36 @@ class CaseTag(BlockNode, name="case"):
                 node.render(context, output)
                 return
 
+    def stream(self, context):
+        value = self.term.resolve(context)
+        for node in self.nodelist:
+            other = node.term.resolve(context) if node.name == "when" else value
+            if value == other:
+                yield from node.stream(context)
+                return
+
+    async def astream(self, context):
+        value = await self.term.resolve_async(context)
+        for node in self.nodelist:
+            other = await node.term.resolve_async(context) if node.name == "when" else value
+            if value == other:
+                async for chunk in node.astream(context):
+                    yield chunk
+                return
+
+    def analyse(self, analyser):
+        analyser.read(self.term)
+        analyser.nodelist(self.nodelist)
+
+    def codegen(self, gen):
+        value = gen.tmp("v")
+        gen.emit(f"{value} = {codegen_expr(self.term, gen)}")
+        for idx, node in enumerate(self.nodelist):
+            other = codegen_expr(node.term, gen) if node.name == "when" else value
+            gen.emit(f"{'el' if idx else ''}if {value} == {other}:")
+            with gen.indent():
+                node.codegen(gen)
+
 
 class WhenTag(BlockNode, name="when"):
     def __init__(self, term, nodelist):
@@ -550,6 +2535,191 @@ class WhenTag(BlockNode, name="when"):
     def render(self, context, output):
         self.nodelist.render(context, output)
 
+    def stream(self, context):
+        yield from self.nodelist.stream(context)
+
+    async def astream(self, context):
+        async for chunk in self.nodelist.astream(context):
+            yield chunk
+
+    def analyse(self, analyser):
+        analyser.read(self.term)
+        analyser.nodelist(self.nodelist)
+
+    def codegen(self, gen):
+        self.nodelist.codegen(gen)
+
 
 class EndCaseTag(BlockNode, name="endcase"):
     pass
+
+
+class Profiler:
+    """Time every node rendered while active, attributed to the template and line it came from.
+
+    Only renders in the thread (or asyncio task) that entered the Profiler are timed, and while no Profiler is active,
+    rendering is not affected at all.  Parts of compiled templates are not instrumented.
+
+        with Profiler() as profiler:
+            tmpl.render(context)
+        print(profiler.report())
+    """
+
+    _active = contextvars.ContextVar("stencil_profilers", default=())  # Profilers active in this thread or task
+    _lock = threading.Lock()
+    _users = 0  # Active profilers in all threads; Nodelist.render is patched while there are any
+    _original = None
+
+    def __init__(self):
+        self.nodes = defaultdict(lambda: [0, 0.0, 0.0])  # origin: [calls, total, own]
+        self.templates = defaultdict(lambda: [0, 0.0, 0.0])  # template name: [nodes rendered, total, own]
+        self.stacks = Counter()  # (origin, ...): own time
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __enter__(self):
+        with Profiler._lock:
+            if not Profiler._users:
+                Profiler._original = Nodelist.__dict__["render"]
+                Nodelist.render = Profiler.render_nodelist
+            Profiler._users += 1
+        self._active.set((*self._active.get(), self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._active.set(tuple(profiler for profiler in self._active.get() if profiler is not self))
+        with Profiler._lock:
+            Profiler._users -= 1
+            if not Profiler._users:
+                Nodelist.render = Profiler._original
+
+    @staticmethod
+    def render_nodelist(nodelist, context, output):
+        """Replaces Nodelist.render while any Profiler is active, timing nodes for those active in this thread."""
+        profilers = Profiler._active.get()
+        for node in nodelist:
+            origin = node.origin or (None, None, type(node).__name__)
+            frames = [profiler.enter_node(origin) for profiler in profilers]
+            start = time.perf_counter()
+            try:
+                node.render(context, output)
+            finally:
+                elapsed = time.perf_counter() - start
+                for profiler, frame in zip(profilers, frames, strict=True):
+                    profiler.exit_node(frame, elapsed)
+
+    def enter_node(self, origin):
+        frame = [origin, 0.0]  # Time spent in children
+        self.local.__dict__.setdefault("stack", []).append(frame)
+        return frame
+
+    def exit_node(self, frame, elapsed):
+        stack = self.local.stack
+        path = tuple(outer for outer, _ in stack)
+        stack.pop()
+        if stack:
+            stack[-1][1] += elapsed
+        origin, own, outer = frame[0], elapsed - frame[1], path[:-1]
+        with self.lock:
+            for stats, recursive in (
+                (self.nodes[origin], origin in outer),
+                (self.templates[origin[0]], any(parent[0] == origin[0] for parent in outer)),
+            ):
+                stats[0] += 1
+                if not recursive:  # Count time spent inside itself once
+                    stats[1] += elapsed
+                stats[2] += own
+            self.stacks[path] += own
+
+    def node_stats(self):
+        """Return {(template, line, source): NodeStats}, slowest first by total time."""
+        ranked = sorted(self.nodes.items(), key=lambda item: item[1][1], reverse=True)
+        return {origin: NodeStats(*stats) for origin, stats in ranked}
+
+    def template_stats(self):
+        """Return {template: NodeStats} of the nodes rendered from each template, slowest first by total time."""
+        ranked = sorted(self.templates.items(), key=lambda item: item[1][1], reverse=True)
+        return {name: NodeStats(*stats) for name, stats in ranked}
+
+    def report(self, limit=20):
+        lines = [f"{'calls':>8} {'total ms':>10} {'own ms':>10}  template:line  source"]
+        for (name, line, source), stats in list(self.node_stats().items())[:limit]:
+            lines.append(
+                f"{stats.calls:8} {stats.total * 1000:10.3f} {stats.own * 1000:10.3f}  {name}:{line}  {source[:60]}"
+            )
+        lines += ["", f"{'nodes':>8} {'total ms':>10} {'own ms':>10}  template"]
+        for name, stats in self.template_stats().items():
+            lines.append(f"{stats.calls:8} {stats.total * 1000:10.3f} {stats.own * 1000:10.3f}  {name}")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        """Return stacks in the collapsed format read by flamegraph.pl and speedscope, in microseconds."""
+        lines = []
+        for path, own in self.stacks.items():
+            frames = ";".join(f"{name}:{line} {source}".replace(";", ",") for name, line, source in path)
+            lines.append(f"{frames} {round(own * 1e6)}")
+        return "\n".join(lines) + "\n"
+
+
+def _map_batches(pool, func, items, size, window):
+    """Yield func(batch) for batches of items, in order, with at most ``window`` batches in progress."""
+    pending, batch = deque(), []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            pending.append(pool.submit(func, batch))
+            batch = []
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+    if batch:
+        pending.append(pool.submit(func, batch))
+    while pending:
+        yield from pending.popleft().result()
+
+
+_worker_render = None
+
+
+def _start_render_worker(data, escape):
+    global _worker_render  # noqa: PLW0603
+    _worker_render = pickle.loads(data).renderer(escape)  # noqa: S301 - our own pickle of the template
+
+
+def _render_batch(batch):
+    return [_worker_render(data) for data in batch]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m stencil")
+    commands = parser.add_subparsers(dest="command", required=True)
+    precompile = commands.add_parser("precompile", help="load every template, reporting errors and timings")
+    precompile.add_argument("paths", nargs="+", help="template directories")
+    precompile.add_argument("--cache-dir", help="store parsed templates here, for TemplateLoader(cache_dir=...)")
+    precompile.add_argument("--compiled", action="store_true", help="also compile templates to Python")
+    precompile.add_argument("-j", "--jobs", type=int, help="number of processes to parse with")
+    precompile.add_argument("-q", "--quiet", action="store_true", help="only report errors")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        cache_dir = args.cache_dir or (scratch if args.jobs else None)
+        loader = TemplateLoader(args.paths, compiled=args.compiled, cache_dir=cache_dir)
+        start = time.perf_counter()
+        results = loader.preload(processes=args.jobs)
+        elapsed = time.perf_counter() - start
+
+    errors = 0
+    for result in results:
+        if result.error is not None:
+            errors += 1
+            print(f"{result.name}: {result.error}", file=sys.stderr)
+        elif not args.quiet:
+            print(f"{result.name}: {result.seconds * 1000:.2f}ms")
+    print(f"{len(results)} templates, {errors} errors in {elapsed:.2f}s", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    # Run through the imported module, so precompiled templates pickle as stencil.*, not __main__.*
+    import stencil
+
+    sys.exit(stencil.main())
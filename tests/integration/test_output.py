@@ -7,6 +7,7 @@ import stencil
 
 class IntegrationTestCase(unittest.TestCase):
     dir_tpl = "tests/integration/tmpl/"
+    context_class = stencil.Context
 
     @staticmethod
     def basename(file_name, extension):
@@ -26,7 +27,7 @@ class IntegrationTestCase(unittest.TestCase):
         out = self.read_text_data(base)
         data = self.read_json_data(base)
 
-        c = stencil.Context(data)
+        c = self.context_class(data)
         result = t.render(c)
 
         assert result == out, "Mismatched output for %r\n%r\n%r" % (base, out, result)
@@ -87,3 +88,13 @@ class IntegrationTestCase(unittest.TestCase):
 
     def test_with(self):
         self.assert_output("11_with")
+
+
+class CompiledIntegrationTestCase(IntegrationTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.loader = stencil.TemplateLoader([IntegrationTestCase.dir_tpl], compiled=True)
+
+
+class FlatContextIntegrationTestCase(IntegrationTestCase):
+    context_class = stencil.FlatContext
@@ -0,0 +1,57 @@
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+class AnalyseTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write(
+            "base.html",
+            "{% block title %}{{ site.name }}{% endblock %}{% block body %}{% endblock %}"
+            '{% include "footer.html" year=now.year %}',
+        )
+        self.write("footer.html", "{{ year }} {{ site.owner }}")
+        self.write(
+            "page.html",
+            '{% extends "base.html" %}{% block title %}{{ page.title }} {{ block.super }}{% endblock %}'
+            "{% block body %}{% for o in orders %}{{ o.customer.name }}{{ o.meta['status'] }}{{ loop.index }}"
+            "{% else %}{{ empty }}{% endfor %}{% with u=user.profile %}{% if u.admin %}{{ fmt(u.age, 2) }}{% endif %}"
+            "{% endwith %}{% endblock %}",
+        )
+        self.write("tree.html", '{{ node.name }}{% for node in node.children %}{% include "tree.html" %}{% endfor %}')
+        self.expected = stencil.Analysis(
+            variables={"site", "now", "page", "orders", "empty", "user", "fmt"},
+            paths={
+                "site.name", "site.owner", "now.year", "page.title", "orders", "orders[].customer.name",
+                "orders[].meta['status']", "empty", "user.profile", "user.profile.admin", "user.profile.age", "fmt",
+            },
+            locals={"year", "block", "loop", "loopcounter", "o", "u"},
+            templates={"base.html", "footer.html"},
+        )  # fmt: skip
+
+    def test_linked(self):
+        for compiled in (False, True):
+            loader = stencil.TemplateLoader([self.root / "tmpl"], compiled=compiled)
+            self.assertEqual(loader.analyse("page.html"), self.expected)
+
+    def test_unlinked(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        tmpl = stencil.Template((self.root / "tmpl" / "page.html").read_text(), loader=loader)
+        self.assertEqual(tmpl.analyse(), self.expected)
+
+    def test_dynamic(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        src = "{% extends parent %}{% block a %}{% include name x=y.z %}{% endblock %}"
+        tmpl = stencil.Template(src, loader=loader)
+        analysis = stencil.Analysis({"parent", "name", "y"}, {"parent", "name", "y.z"}, {"block"}, set())
+        self.assertEqual(tmpl.analyse(), analysis)
+
+    def test_recursive(self):
+        analysis = stencil.TemplateLoader([self.root / "tmpl"]).analyse("tree.html")
+        self.assertEqual(analysis.variables, {"node"})
+        self.assertEqual(analysis.paths, {"node.name", "node.children"})
+        self.assertEqual(analysis.templates, {"tree.html"})
+
+    def test_without_loader(self):
+        analysis = stencil.Template("{% with a=b.c d=True %}{{ a.e[0] }}{{ d }}{% endwith %}{{ a }}").analyse()
+        self.assertEqual(analysis, stencil.Analysis({"a", "b"}, {"a", "b.c", "b.c.e[0]"}, {"a", "d"}, set()))
@@ -0,0 +1,69 @@
+import asyncio
+import unittest
+
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+async def fetch(value):
+    await asyncio.sleep(0)
+    return value
+
+
+async def numbers(count):
+    for idx in range(count):
+        await asyncio.sleep(0)
+        yield idx
+
+
+class User:
+    def __init__(self, name):
+        self.name = name
+
+    async def friends(self):
+        return [User("Alice"), User("<Bob>")]
+
+
+class AsyncRenderTestCase(unittest.TestCase):
+    def render(self, src, data):
+        return asyncio.run(stencil.Template(src).render_async(data))
+
+    def test_awaitables(self):
+        src = "{{ user.name }}: {% for f in user.friends() %}{{ f.name }},{% endfor %} {{ fetch(1) }}"
+        result = self.render(src, {"user": User("Carol"), "fetch": fetch})
+        self.assertEqual(result, "Carol: Alice,&lt;Bob&gt;, 1")
+
+    def test_awaitable_value(self):
+        src = "{% if user %}{{ user.name }}{% endif %} {% with u=user %}{{ u.name }}{% endwith %} {{ user.name }}"
+        self.assertEqual(self.render(src, {"user": fetch(User("Dan"))}), "Dan Dan Dan")
+
+    def test_async_for(self):
+        src = "{% for x in numbers(n) %}{{ loopcounter }}={{ x }} {% else %}none{% endfor %}"
+        self.assertEqual(self.render(src, {"numbers": numbers, "n": 3}), "0=0 1=1 2=2 ")
+        self.assertEqual(self.render(src, {"numbers": numbers, "n": 0}), "none")
+
+    def test_if(self):
+        src = "{% if flag() %}yes{% else %}no{% endif %}"
+        self.assertEqual(self.render(src, {"flag": lambda: fetch(False)}), "no")
+
+
+class AsyncLoaderTestCase(LoaderTestCase):
+    def test_inheritance(self):
+        self.write("base.html", "<h1>{% block title %}{{ fetch('Base') }}{% endblock %}</h1>")
+        self.write("row.html", "{{ fetch(x) }};")
+        self.write(
+            "page.html",
+            '{% extends "base.html" %}{% block title %}{{ block.super }} & '
+            '{% for x in numbers(2) %}{% include "row.html" x=x %}{% endfor %}{% endblock %}',
+        )
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+
+        async def run():
+            tmpl = await loader.get_async("page.html")
+            data = {"fetch": fetch, "numbers": numbers}
+            chunks = [chunk async for chunk in tmpl.stream_async(data, chunk_size=4)]
+            return await tmpl.render_async(data), chunks
+
+        result, chunks = asyncio.run(run())
+        self.assertEqual(result, "<h1>Base & 0;1;</h1>")
+        self.assertEqual("".join(chunks), result)
@@ -0,0 +1,61 @@
+import io
+import pickle
+import socket
+import threading
+import unittest
+
+import stencil
+
+
+class ByteOutputTestCase(unittest.TestCase):
+    src = "<p>café {{ a }}</p>{% for x in xs %}<i>{{ x }}</i>{% endfor %}☃"
+    data = {"a": "<ü>", "xs": range(100)}  # noqa: RUF012
+
+    def setUp(self):
+        self.expected = stencil.Template(self.src).render(self.data).encode()
+
+    def test_text(self):
+        text = stencil.Text("café")
+        self.assertEqual(text.encoded, "café".encode())
+        self.assertEqual(pickle.loads(pickle.dumps(text)).encoded, text.encoded)  # noqa: S301
+        self.assertIsInstance(stencil.Template("abc").nodelist[0].content, stencil.Text)
+
+    def test_render_bytes(self):
+        for compiled in (False, True):
+            tmpl = stencil.Template(self.src, compiled=compiled)
+            self.assertEqual(tmpl.render_bytes(self.data), self.expected)
+            self.assertEqual(tmpl.render_bytes(self.data, encoding="utf-16"), self.expected.decode().encode("utf-16"))
+
+    def test_targets(self):
+        tmpl = stencil.Template(self.src)
+        buf = bytearray()
+        self.assertIsNone(tmpl.render_bytes(self.data, buf, flush_size=16))
+        self.assertEqual(bytes(buf), self.expected)
+
+        fout = io.BytesIO()
+        tmpl.render_bytes(self.data, fout)
+        self.assertEqual(fout.getvalue(), self.expected)
+
+        sink = stencil.ByteSink(flush_size=1 << 20)
+        tmpl.render(self.data, sink)
+        self.assertEqual(len(sink.target), 0)
+        self.assertEqual(sink.getvalue(), self.expected)
+
+    def test_socket(self):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        received = []
+
+        def read():
+            while chunk := right.recv(1000):
+                received.append(chunk)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        data = {"a": "x" * 100_000, "xs": range(20_000)}
+        stencil.Template(self.src).render_bytes(data, left, flush_size=1 << 18)
+        left.shutdown(socket.SHUT_WR)
+        reader.join()
+        self.assertEqual(b"".join(received), stencil.Template(self.src).render(data).encode())
@@ -0,0 +1,158 @@
+import asyncio
+import itertools
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+class CacheTagTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = stencil.LocalCache(maxsize=2)
+        patcher = mock.patch.object(stencil.CacheTag, "backend", self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.counter = itertools.count()
+        self.src = '{% cache "frag" timeout x %}[{{ x }}{{ n() }}]{% endcache %}'
+
+    def render(self, tmpl, x=1, timeout=None):
+        return tmpl.render({"x": x, "n": lambda: next(self.counter), "timeout": timeout})
+
+    def test_cache(self):
+        for compiled in (False, True):
+            self.backend.clear()
+            tmpl = stencil.Template(self.src, compiled=compiled)
+            first = self.render(tmpl)
+            self.assertEqual(self.render(tmpl), first)
+            self.assertNotEqual(self.render(tmpl, x=2), first)
+            self.assertEqual("".join(tmpl.stream({"x": 1})), first)
+        self.assertEqual(self.backend.cache_info(), stencil.CacheInfo(4, 4, 0, 2, 2))
+
+    def test_timeout(self):
+        tmpl = stencil.Template(self.src)
+        with mock.patch("time.time", return_value=1000):
+            self.assertEqual(self.render(tmpl, timeout=10), "[10]")
+        with mock.patch("time.time", return_value=1009):
+            self.assertEqual(self.render(tmpl, timeout=10), "[10]")
+        with mock.patch("time.time", return_value=1011):
+            self.assertEqual(self.render(tmpl, timeout=10), "[11]")
+
+    def test_lru(self):
+        tmpl = stencil.Template(self.src)
+        for x in (1, 2, 1, 3):
+            self.render(tmpl, x=x)
+        self.assertEqual(list(self.backend.entries), ["frag:1", "frag:3"])
+        self.assertEqual(self.backend.evictions, 1)
+
+    def test_async(self):
+        tmpl = stencil.Template(self.src)
+        first = asyncio.run(tmpl.render_async({"x": 1, "n": lambda: next(self.counter), "timeout": None}))
+        self.assertEqual(first, "[10]")
+        self.assertEqual(self.render(tmpl), first)
+
+    def test_static(self):
+        tmpl = stencil.Template('{% cache "a" %}static{% endcache %}')
+        self.assertEqual(tmpl.nodelist[0].content, "static")
+
+    def test_nested(self):
+        tmpl = stencil.Template('{% cache "a" %}<{% cache "a" %}{{ n() }}{% endcache %}>{% endcache %}')
+        self.assertEqual(self.render(tmpl), "<0>")
+        self.assertEqual(self.render(tmpl), "<0>")
+
+    def test_syntax(self):
+        self.assertRaises(SyntaxError, stencil.Template, "{% cache %}{% endcache %}")
+        self.assertRaises(SyntaxError, stencil.Template, '{% cache "a", 10 %}x{% endcache %}')
+
+
+class StampedeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = stencil.LocalCache()
+        self.gate = threading.Event()
+        self.calls = []
+
+    def render(self):
+        self.calls.append(1)
+        self.gate.wait(5)
+        return f"v{len(self.calls)}"
+
+    def test_single_render(self):
+        with ThreadPoolExecutor(8) as pool:
+            futures = [pool.submit(self.cache.fetch, "k", None, self.render) for _ in range(8)]
+            time.sleep(0.05)
+            self.gate.set()
+            self.assertEqual({future.result() for future in futures}, {"v1"})
+        self.assertEqual(self.calls, [1])
+
+    def test_stale(self):
+        self.cache.set("k", "old", time.time() - 1)
+        with ThreadPoolExecutor(1) as pool:
+            future = pool.submit(self.cache.fetch, "k", 60, self.render)
+            time.sleep(0.05)
+            self.assertEqual(self.cache.fetch("k", 60, self.render), "old")
+            self.gate.set()
+            self.assertEqual(future.result(), "v1")
+        self.assertEqual(self.cache.fetch("k", 60, self.render), "v1")
+
+    def test_error(self):
+        def fail():
+            raise ValueError("boom")
+
+        self.assertRaises(ValueError, self.cache.fetch, "k", None, fail)
+        self.assertFalse(self.cache.loading)
+        self.gate.set()
+        self.assertEqual(self.cache.fetch("k", None, self.render), "v1")
+
+
+class FileCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def test_shared(self):
+        one, two = stencil.FileCache(self.directory), stencil.FileCache(self.directory)
+        self.assertEqual(one.fetch("k", None, lambda: "a\r\nb ☃"), "a\r\nb ☃")
+        self.assertEqual(two.fetch("k", None, lambda: "other"), "a\r\nb ☃")
+        self.assertEqual(two.cache_info().currsize, 1)
+        two.delete("k")
+        self.assertIsNone(one.get("k"))
+
+    def test_claimed(self):
+        one, two = stencil.FileCache(self.directory), stencil.FileCache(self.directory, lock_timeout=0.2)
+        one.set("k", "old", time.time() - 1)
+        self.assertTrue(one.claim("k"))
+        # Another process is rendering it: use the expired text
+        self.assertEqual(two.fetch("k", 60, lambda: "new"), "old")
+        time.sleep(0.25)
+        # Until its claim is too old
+        self.assertEqual(two.fetch("k", 60, lambda: "new"), "new")
+        self.assertFalse(two.path("k", ".lock").exists())
+
+    def test_damaged(self):
+        cache = stencil.FileCache(self.directory)
+        cache.path("k").write_bytes(b"soon\nold")
+        self.assertIsNone(cache.get("k"))
+        self.assertEqual(cache.fetch("k", 60, lambda: "new"), "new")
+
+    def test_failed_write(self):
+        cache = stencil.FileCache(self.directory)
+        with mock.patch("os.replace", side_effect=OSError), self.assertRaises(OSError):
+            cache.set("k", "text", None)
+        self.assertEqual(list(Path(self.directory).iterdir()), [])
+
+
+class LoaderBackendTestCase(LoaderTestCase):
+    def test_loader_backend(self):
+        self.write("page.html", '{% cache "page" %}{{ n() }}{% endcache %}')
+        backend = stencil.LocalCache()
+        loader = stencil.TemplateLoader([self.root / "tmpl"], fragment_cache=backend)
+        counter = itertools.count()
+        for _ in range(2):
+            self.assertEqual(loader["page.html"].render({"n": lambda: next(counter)}), "0")
+        self.assertEqual(backend.get("page")[0], "0")
@@ -0,0 +1,51 @@
+import unittest
+
+from stencil import BlockNode, Context, SafeStr, Template
+
+
+class ShoutTag(BlockNode, name="shout"):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    @classmethod
+    def parse(cls, _content, parser):
+        return cls(parser.parse_nodelist({"endshout"}))
+
+    def render(self, context, output):
+        self.nodelist.render(context, output)
+        output.write("!")
+
+
+class EndShoutTag(BlockNode, name="endshout"):
+    pass
+
+
+class CompileTests(unittest.TestCase):
+    def assert_same(self, src, data):
+        expected = Template(src).render(Context(dict(data)))
+        result = Template(src, compiled=True).render(Context(dict(data)))
+        self.assertEqual(result, expected)
+        return result
+
+    def test_var(self):
+        result = self.assert_same("{{ a }} {{ b }} {{ c.real }} {{ d[1] }} {{ f(2, 3) }}", {
+            "a": "<b>", "b": SafeStr("<i>"), "c": 3, "d": [1, 2], "f": max,
+        })  # fmt: skip
+        self.assertEqual(result, "&lt;b&gt; <i> 3 2 3")
+
+    def test_for(self):
+        src = "{% for x in items %}{{ loopcounter }}:{{ x }},{% else %}empty{% endfor %}"
+        self.assertEqual(self.assert_same(src, {"items": "abc"}), "0:a,1:b,2:c,")
+        self.assertEqual(self.assert_same(src, {"items": []}), "empty")
+
+    def test_if_with(self):
+        src = "{% if not a %}no{% else %}{% with b=a %}{{ b }}{{ 1.5 }}{% endwith %}{% endif %}"
+        self.assertEqual(self.assert_same(src, {"a": 0}), "no")
+        self.assertEqual(self.assert_same(src, {"a": "x"}), "x1.5")
+
+    def test_deep_nesting(self):
+        src = "{% for x in a %}" * 12 + "{{ x }}" + "{% endfor %}" * 12
+        self.assertEqual(self.assert_same(src, {"a": [1]}), "1")
+
+    def test_fallback(self):
+        self.assertEqual(self.assert_same("{% shout %}{{ a }}{% endshout %}", {"a": "hi"}), "hi!")
@@ -1,6 +1,9 @@
+import asyncio
+import pickle
 import unittest
+from types import SimpleNamespace
 
-from stencil import Template
+from stencil import AstChain, AstLookup, Context, Expression, Template
 
 
 class ExpressionTests(unittest.TestCase):
@@ -16,3 +19,67 @@ class ExpressionTests(unittest.TestCase):
         t = Template("Test {{double(double(1))}}").render({"double": double})
 
         self.assertEqual(t, "Test 4")
+
+    def test_cached(self):
+        self.assertIs(Expression.parse("user.name"), Expression.parse("user.name"))
+
+    def test_literals(self):
+        t = Template("{{ 'a\\'b' }} {{ 1_000 }} {{ .5 }} {{ 2e3 }}").render({})
+
+        self.assertEqual(t, "a\\&#x27;b 1000 0.5 2000.0")
+
+    def test_kwargs(self):
+        t = Template("{% with a=1 b='x' c=d.real %}{{ a }}{{ b }}{{ c }}{% endwith %}").render({"d": 3})
+
+        self.assertEqual(t, "1x3")
+
+    def test_errors(self):
+        for src in ("a + b", "a..b", "'open", "f(1", "a[1", "1_", "1__0"):
+            with self.subTest(src=src), self.assertRaises(SyntaxError):
+                Expression.parse(src)
+
+
+class ChainTests(unittest.TestCase):
+    def setUp(self):
+        self.data = {
+            "user": SimpleNamespace(profile=SimpleNamespace(address={"city": "Paris", 0: "first"}), tags=["a", "b"]),
+            "key": "city",
+        }
+
+    def resolve(self, src, data=None):
+        return Expression.parse(src).resolve(Context(data or self.data))
+
+    def test_flattened(self):
+        expr = Expression.parse("user.profile.address['city'][0]")
+        self.assertIsInstance(expr, AstChain)
+        self.assertEqual(expr.steps, ((True, "profile"), (True, "address"), (False, "city"), (False, 0)))
+        self.assertEqual(len(expr.getters), 3)
+        self.assertIsInstance(Expression.parse("user.profile.address[key]"), AstLookup)
+        self.assertIsInstance(Expression.parse("user.profile.address[key].upper"), AstChain)
+
+    def test_resolve(self):
+        self.assertEqual(self.resolve("user.profile.address['city']"), "Paris")
+        self.assertEqual(self.resolve("user.profile.address[0].upper()"), "FIRST")
+        self.assertEqual(self.resolve("user.profile.address[key].lower"), "Paris".lower)
+        self.assertEqual(self.resolve("user.tags[1]"), "b")
+
+    def test_missing(self):
+        self.assertEqual(self.resolve("user.profile.missing.city"), "")
+        self.assertEqual(self.resolve("nobody.profile.address"), "")
+        self.assertRaises(KeyError, self.resolve, "user.profile.address['town']")
+        self.assertRaises(IndexError, self.resolve, "user.missing[0]")
+
+    def test_walked(self):
+        expr = Expression.parse("item.count.real")
+        items = [SimpleNamespace(count=1), SimpleNamespace(), SimpleNamespace(count=2)]
+        results = [expr.resolve(Context({"item": item})) for item in items]
+        self.assertEqual(results, [1, "", 2])
+        self.assertIn(SimpleNamespace, expr.walked)
+        self.assertEqual(pickle.loads(pickle.dumps(expr)).walked, set())  # noqa: S301
+
+    def test_compiled_async(self):
+        src = "{{ user.profile.address['city'] }}{{ user.tags[0].upper() }}{{ user.profile.nothing.at.all }}|"
+        expected = Template(src).render(self.data)
+        self.assertEqual(expected, "ParisA|")
+        self.assertEqual(Template(src, compiled=True).render(self.data), expected)
+        self.assertEqual(asyncio.run(Template(src).render_async(self.data)), expected)
@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+def tree_node(name, children):
+    return SimpleNamespace(name=name, children=children)
+
+
+class IncludeTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("row.html", "<{{ x }}{% if sep %}{{ sep }}{% endif %}>")
+        self.write("table.html", '{% for x in xs %}{% include "row.html" sep=sep %}{% endfor %}|{{ x }}')
+        self.write(
+            "tree.html", '{{ node.name }}{% for node in node.children %}({% include "tree.html" %}){% endfor %}'
+        )
+        self.write("blocks.html", "{% block a %}A{% endblock %}")
+        self.write("uses_blocks.html", '{% include "blocks.html" %}')
+        self.write("missing.html", '{% if x %}{% include "nope.html" %}{% endif %}ok')
+        self.data = {"xs": [1, 2], "sep": ";", "x": "outer"}
+        self.expected = "<1;><2;>|outer"
+
+    def test_linked(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        tmpl = loader["table.html"]
+        (include,) = tmpl.nodelist.nodes_by_type(stencil.IncludeTag)
+        self.assertIs(include.template, loader["row.html"])
+        self.assertEqual(set(tmpl.dependencies), {"row.html"})
+        self.assertEqual(tmpl.render(self.data), self.expected)
+        self.assertEqual("".join(tmpl.stream(self.data)), self.expected)
+        self.assertEqual(asyncio.run(tmpl.render_async(self.data)), self.expected)
+        self.assertEqual(tmpl.render(stencil.FlatContext(self.data)), self.expected)
+
+    def test_compiled(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"], compiled=True)
+        self.assertEqual(loader["table.html"].render(self.data), self.expected)
+        self.assertEqual(loader["table.html"].render(stencil.FlatContext(self.data)), self.expected)
+
+    def test_not_linked(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        for name in ("tree.html", "uses_blocks.html", "missing.html"):
+            with self.subTest(name):
+                (include,) = loader[name].nodelist.nodes_by_type(stencil.IncludeTag)
+                self.assertIsNone(include.template)
+        tree = tree_node("a", [tree_node("b", [tree_node("c", [])])])
+        self.assertEqual(loader["tree.html"].render({"node": tree}), "a(b(c))")
+        self.assertEqual(loader["uses_blocks.html"].render({}), "A")
+        self.assertEqual(loader["missing.html"].render({}), "ok")
+
+    def test_included_changed(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"], check_interval=0)
+        self.assertEqual(loader["table.html"].render(self.data), self.expected)
+        self.write("row.html", "[{{ x }}]")
+        self.assertEqual(loader["table.html"].render(self.data), "[1][2]|outer")
@@ -0,0 +1,90 @@
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+class InheritanceTemplatesTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("base.html", "<title>{% block title %}Site{% endblock %}</title>{% block body %}{% endblock %}")
+        self.write(
+            "layout.html",
+            '{% extends "base.html" %}{% block title %}{{ block.super }} - Layout{% endblock %}'
+            "{% block body %}<main>{% block content %}default{% endblock %}</main>{% endblock %}",
+        )
+        self.write(
+            "page.html",
+            '{% extends "layout.html" %}{% block title %}{{ name }} | {{ block.super }}{% endblock %}'
+            "{% block content %}{% for x in xs %}{{ x }}{% endfor %}|{{ block.super }}{% endblock %}",
+        )
+        self.write("dynamic.html", "{% extends parent %}{% block content %}dyn {{ block.super }}{% endblock %}")
+        self.expected = "<title>Page | Site - Layout</title><main>12|default</main>"
+
+
+class InheritanceTestCase(InheritanceTemplatesTestCase):
+    def test_linked(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        tmpl = loader["page.html"]
+        self.assertIsNone(tmpl.extends)
+        self.assertEqual(set(tmpl.dependencies), {"layout.html"})
+        self.assertEqual(tmpl.render({"name": "Page", "xs": [1, 2]}), self.expected)
+        self.assertEqual("".join(tmpl.stream({"name": "Page", "xs": [1, 2]})), self.expected)
+
+    def test_compiled(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"], compiled=True)
+        self.assertEqual(loader["page.html"].render({"name": "Page", "xs": [1, 2]}), self.expected)
+
+    def test_unlinked_matches(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        unlinked = stencil.Template((self.root / "tmpl" / "page.html").read_text(), loader=loader)
+        self.assertIsNotNone(unlinked.extends)
+        self.assertEqual(unlinked.render({"name": "Page", "xs": [1, 2]}), self.expected)
+
+    def test_dynamic(self):
+        for compiled in (False, True):
+            loader = stencil.TemplateLoader([self.root / "tmpl"], compiled=compiled)
+            tmpl = loader["dynamic.html"]
+            self.assertIsNotNone(tmpl.extends)
+            self.assertEqual(tmpl.render({"parent": "page.html", "name": "Page", "xs": [3]}), (
+                "<title>Page | Site - Layout</title><main>dyn 3|default</main>"
+            ))  # fmt: skip
+            self.assertEqual(tmpl.render({"parent": "base.html"}), "<title>Site</title>")
+
+    def test_parent_changed(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"], check_interval=0)
+        self.assertEqual(loader["page.html"].render({"name": "Page", "xs": [1, 2]}), self.expected)
+        self.write("base.html", "{% block title %}New{% endblock %}!")
+        self.assertEqual(loader["page.html"].render({"name": "Page"}), "Page | New - Layout!")
+
+
+class RenderBlockTestCase(InheritanceTemplatesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write(
+            "list.html",
+            '{% extends "base.html" %}{% block body %}{% with sep="," %}<ul>{% for x in xs %}'
+            "{% block item %}<li>{{ x }}{{ sep }}</li>{% endblock %}{% endfor %}</ul>{% endwith %}{% endblock %}",
+        )
+        self.data = {"name": "Page", "xs": [1, 2]}
+
+    def test_render_block(self):
+        for compiled in (False, True):
+            loader = stencil.TemplateLoader([self.root / "tmpl"], compiled=compiled)
+            tmpl = loader["page.html"]
+            self.assertEqual(tmpl.render_block("title", self.data), "Page | Site - Layout")
+            self.assertEqual(tmpl.render_block("content", self.data), "12|default")
+            self.assertEqual(tmpl.render_block("body", self.data), "<main>12|default</main>")
+            self.assertRaises(LookupError, tmpl.render_block, "missing", self.data)
+
+    def test_unlinked(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        unlinked = stencil.Template((self.root / "tmpl" / "page.html").read_text(), loader=loader)
+        self.assertEqual(unlinked.render_block("content", self.data), "12|default")
+        dynamic = loader["dynamic.html"]
+        self.assertEqual(dynamic.render_block("content", {"parent": "page.html", "xs": [3]}), "dyn 3|default")
+        self.assertEqual(dynamic.render_block("title", {"parent": "base.html"}), "Site")
+
+    def test_scoped(self):
+        tmpl = stencil.TemplateLoader([self.root / "tmpl"])["list.html"]
+        self.assertEqual(tmpl.render_block("item", {"x": 5}), "<li>5</li>")
+        self.assertEqual(tmpl.render_block("item", self.data, scoped=True), "<li>1,</li><li>2,</li>")
+        self.assertEqual(tmpl.render(self.data), "<title>Site</title><ul><li>1,</li><li>2,</li></ul>")
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+
+from stencil import Context, FlatContext, Lazy, Template, TemplateLoader
+from tests.unit.test_loader import LoaderTestCase
+
+
+class Counter:
+    def __init__(self, value="v"):
+        self.value, self.calls = value, 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+class LazyTestCase(LoaderTestCase):
+    def render(self, src, data, **kwargs):
+        return Template(src, **kwargs).render(data)
+
+    def test_once_per_render(self):
+        for compiled in (False, True):
+            for context_type in (Context, FlatContext):
+                with self.subTest(compiled=compiled, context_type=context_type):
+                    func = Counter("abc")
+                    src = "{{ a }}{{ a.upper() }}{% if a %}{{ a[0] }}{% endif %}"
+                    data = {"a": Lazy(func)}
+                    self.assertEqual(self.render(src, context_type(data), compiled=compiled), "abcABCa")
+                    self.assertEqual(func.calls, 1)
+                    self.assertEqual(self.render(src, context_type(data), compiled=compiled), "abcABCa")
+                    self.assertEqual(func.calls, 2)
+
+    def test_unused(self):
+        func = Counter()
+        self.assertEqual(self.render("{% if show %}{{ a }}{% endif %}.", {"a": Lazy(func), "show": False}), ".")
+        self.assertEqual(func.calls, 0)
+
+    def test_with_include(self):
+        for compiled in (False, True):
+            func = Counter()
+            src = "{% with b=a c=1 %}[{% if c %}{{ b }}{% endif %}{{ a }}]{% endwith %}{% with b=a %}{% endwith %}"
+            self.assertEqual(self.render(src, {"a": Lazy(func)}, compiled=compiled), "[vv]")
+            self.assertEqual(func.calls, 1)
+
+        self.write("row.html", "{% if show %}{{ b }}{% endif %}|")
+        self.write("page.html", '{% include "row.html" b=a %}{% include name b=a %}')
+        for compiled in (False, True):
+            tmpl = TemplateLoader([self.root / "tmpl"], compiled=compiled)["page.html"]
+            func = Counter()
+            self.assertEqual(tmpl.render({"a": Lazy(func), "name": "row.html", "show": False}), "||")
+            self.assertEqual(func.calls, 0)
+            self.assertEqual(tmpl.render({"a": Lazy(func), "name": "row.html", "show": True}), "v|v|")
+            self.assertEqual(func.calls, 1)
+
+    def test_shared(self):
+        func = Counter()
+        lazy = Lazy(func, shared=True)
+        tmpl = Template("{{ a }}{{ a }}")
+        threads = [threading.Thread(target=tmpl.render, args=({"a": lazy},)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tmpl.render({"a": lazy}), "vv")
+        self.assertEqual(func.calls, 1)
+
+    def test_renderer(self):
+        func = Counter()
+        render = Template("{{ a }}").renderer()
+        data = {"a": Lazy(func)}
+        self.assertEqual([render(data), render(data)], ["v", "v"])
+        self.assertEqual(func.calls, 2)
+
+    def test_async(self):
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            return "x"
+
+        tmpl = Template("{% with b=a %}{{ b }}{{ a.upper() }}{% endwith %}")
+        self.assertEqual(asyncio.run(tmpl.render_async({"a": Lazy(fetch)})), "xX")
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,151 @@
+import io
+import pickle
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import stencil
+
+
+class LoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        (self.root / "tmpl").mkdir()
+
+    def write(self, name, content):
+        (self.root / "tmpl" / name).write_text(content)
+
+
+class CacheDirTestCase(LoaderTestCase):
+    def test_cache_reused(self):
+        self.write("inner.html", "<{{ x }}>")
+        self.write("outer.html", '{% for x in xs %}{% include "inner.html" x=x %}{% endfor %}')
+        cache_dir = self.root / "cache"
+
+        first = stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)
+        self.assertEqual(first["outer.html"].render({"xs": [1, 2]}), "<1><2>")
+        self.assertEqual(len(list(cache_dir.glob("*.pickle"))), 2)
+        self.assertEqual(list(cache_dir.glob("*.tmp")), [])
+
+        second = stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir, compiled=True)
+        with mock.patch.object(stencil.Template, "parse_nodelist", side_effect=AssertionError):
+            tmpl = second["outer.html"]
+            self.assertIs(tmpl.nodelist[0].nodelist[0].loader, second)
+            self.assertEqual(tmpl.render({"xs": [3]}), "<3>")
+        self.assertTrue(tmpl.compiled)
+
+    def test_source_change(self):
+        cache_dir = self.root / "cache"
+        self.write("a.html", "one")
+        self.assertEqual(stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)["a.html"].render({}), "one")
+        self.write("a.html", "two")
+        self.assertEqual(stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)["a.html"].render({}), "two")
+
+    def test_corrupt_entry(self):
+        cache_dir = self.root / "cache"
+        self.write("a.html", "one")
+        stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)["a.html"]
+        for entry in cache_dir.glob("*.pickle"):
+            entry.write_bytes(b"garbage")
+        self.assertEqual(stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)["a.html"].render({}), "one")
+
+    def test_write_fails(self):
+        cache_dir = self.root / "cache"
+        self.write("a.html", "one")
+        loader = stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)
+        with mock.patch.object(loader, "dumps", side_effect=pickle.PicklingError):
+            self.assertEqual(loader.load("a.html").render({}), "one")
+        with mock.patch("os.replace", side_effect=PermissionError):
+            self.assertEqual(loader.load("a.html").render({}), "one")
+        self.assertEqual(list(cache_dir.iterdir()), [])
+        blocked = stencil.TemplateLoader([self.root / "tmpl"], cache_dir=self.root / "tmpl" / "a.html")
+        self.assertEqual(blocked["a.html"].render({}), "one")
+
+
+class CacheLimitTestCase(LoaderTestCase):
+    def test_lru(self):
+        for name in "abc":
+            self.write(name, name)
+        loader = stencil.TemplateLoader([self.root / "tmpl"], maxsize=2)
+        loader["a"], loader["b"], loader["a"], loader["c"]
+        self.assertEqual(list(loader), ["a", "c"])
+        self.assertEqual(loader.cache_info(), stencil.CacheInfo(1, 3, 1, 2, 2))
+
+    def test_revalidate(self):
+        self.write("a", "one")
+        loader = stencil.TemplateLoader([self.root / "tmpl"], check_interval=0)
+        first = loader["a"]
+        self.assertIs(loader["a"], first)
+        self.write("a", "three")
+        self.assertEqual(loader["a"].render({}), "three")
+        self.assertEqual(loader.cache_info().misses, 2)
+
+    def test_revalidate_throttled(self):
+        self.write("a", "one")
+        loader = stencil.TemplateLoader([self.root / "tmpl"], check_interval=3600)
+        loader["a"]
+        self.write("a", "three")
+        self.assertEqual(loader["a"].render({}), "one")
+
+
+class PreloadTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        (self.root / "tmpl" / "sub").mkdir()
+        self.write("base.html", "<{% block a %}{% endblock %}>")
+        self.write("sub/page.html", '{% extends "base.html" %}{% block a %}{{ x }}{% endblock %}')
+        self.write("broken.html", "{% for %}{% endfor %}")
+        self.write(".hidden", "{% for %}")
+
+    def test_list_templates(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"], cache_dir=self.root / "tmpl" / "cache")
+        loader["base.html"]
+        self.assertEqual(loader.list_templates(), ["base.html", "broken.html", "sub/page.html"])
+
+    def test_preload(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        results = {result.name: result for result in loader.preload()}
+        self.assertEqual(set(results), {"base.html", "broken.html", "sub/page.html"})
+        self.assertIsNone(results["sub/page.html"].error)
+        self.assertIn("ValueError", results["broken.html"].error)
+        self.assertIn("sub/page.html", loader)
+        self.assertNotIn("broken.html", loader)
+        self.assertEqual(loader["sub/page.html"].render({"x": 1}), "<1>")
+
+    def test_processes(self):
+        cache_dir = self.root / "cache"
+        self.assertRaises(ValueError, stencil.TemplateLoader([self.root / "tmpl"]).preload, processes=2)
+        loader = stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)
+        results = loader.preload(processes=2)
+        self.assertEqual([result.error is None for result in results], [True, False, True])
+        self.assertEqual(len(list(cache_dir.glob("*.pickle"))), 2)
+        with mock.patch.object(stencil.Template, "parse_nodelist") as parse:
+            fresh = stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)
+            fresh.preload(["base.html", "sub/page.html"])
+            parse.assert_not_called()
+        self.assertEqual(fresh["sub/page.html"].render({"x": 1}), "<1>")
+
+    def test_main(self):
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout, mock.patch("sys.stderr", new=io.StringIO()):
+            self.assertEqual(stencil.main(["precompile", str(self.root / "tmpl")]), 1)
+        self.assertIn("sub/page.html: ", stdout.getvalue())
+        self.write("broken.html", "fixed")
+        with mock.patch("sys.stdout", new_callable=io.StringIO), mock.patch("sys.stderr", new_callable=io.StringIO):
+            self.assertEqual(stencil.main(["precompile", "-j", "2", "--compiled", str(self.root / "tmpl")]), 0)
+
+    def test_command_cache(self):
+        cache_dir = self.root / "cache"
+        tmpl_dir = self.root / "tmpl"
+        command = [sys.executable, "-m", "stencil", "precompile", str(tmpl_dir), "--cache-dir", str(cache_dir)]
+        cwd = Path(stencil.__file__).parent
+        result = subprocess.run(command, cwd=cwd, capture_output=True, check=False)  # noqa: S603
+        self.assertEqual(result.returncode, 1)
+        with mock.patch.object(stencil.Template, "parse_nodelist") as parse:
+            loader = stencil.TemplateLoader([self.root / "tmpl"], cache_dir=cache_dir)
+            self.assertEqual(loader["sub/page.html"].render({"x": 1}), "<1>")
+            parse.assert_not_called()
@@ -0,0 +1,60 @@
+import asyncio
+import unittest
+
+from stencil import Context, FlatContext, Template
+
+SRC = (
+    "{% for k, v in items %}{{ loop.index }}/{{ loop.length }}:{{ k }}={{ v }}"
+    "{% if loop.first %}^{% endif %}{% if loop.last %}${% else %},{% endif %}{% endfor %}"
+)
+
+
+class LoopTests(unittest.TestCase):
+    def render(self, src, data):
+        results = {
+            Template(src, **kwargs).render(context_class(dict(data)))
+            for context_class in (Context, FlatContext)
+            for kwargs in ({}, {"compiled": True})
+        }
+        self.assertEqual(len(results), 1)
+        return results.pop()
+
+    def test_unpack(self):
+        self.assertEqual(self.render(SRC, {"items": {"a": 1, "b": 2}.items()}), "1/2:a=1^,2/2:b=2$")
+
+    def test_generator(self):
+        def items():
+            yield from zip("abc", range(3))
+
+        self.assertEqual(self.render(SRC.replace("items", "items()"), {"items": items}), "1/3:a=0^,2/3:b=1,3/3:c=2$")
+
+    def test_lazy(self):
+        seen = []
+
+        def items():
+            for idx in range(3):
+                seen.append(idx)
+                yield idx
+
+        src = "{% for x in items %}{{ x }}{{ loop.revindex0 }}{% endfor %}"
+        streamed = Template("{% for x in items %}{{ x }}{{ len(seen) }} {% endfor %}")
+        self.assertEqual(streamed.render({"items": items(), "seen": seen, "len": len}), "01 12 23 ")
+        seen.clear()
+        self.assertEqual(Template(src).render({"items": items()}), "021120")
+
+    def test_nested(self):
+        inner = "{% for y in b %}{{ loop.index0 }}{% endfor %}"
+        src = "{% for x in a %}" + inner + "{{ loop.index }}{{ loopcounter }}{% endfor %}"
+        self.assertEqual(self.render(src, {"a": [1, 2], "b": [1, 2]}), "01100121")
+
+    def test_async(self):
+        async def items():
+            for idx in range(3):
+                yield idx
+
+        src = "{% for x in items() %}{{ x }}/{{ loop.length }}{% if loop.last %}.{% endif %} {% endfor %}"
+        self.assertEqual(asyncio.run(Template(src).render_async({"items": items})), "0/3 1/3 2/3. ")
+
+    def test_invalid(self):
+        with self.assertRaises(SyntaxError):
+            Template("{% for a.b in c %}{% endfor %}")
@@ -0,0 +1,59 @@
+import io
+import pickle
+
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+def shout(value):
+    return value.upper()
+
+
+class RenderManyTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("base.html", "<{% block body %}{% endblock %}>")
+        self.write(
+            "mail.html",
+            '{% extends "base.html" %}{% block body %}Dear {{ name }},{% for x in xs %}'
+            '{% include "row.html" %}{% endfor %}{% endblock %}',
+        )
+        self.write("row.html", "[{{ x }}]")
+        self.loader = stencil.TemplateLoader([self.root / "tmpl"], compiled=True)
+        self.tmpl = self.loader["mail.html"]
+        self.rows = [{"name": f"<{n}>", "xs": range(n % 4)} for n in range(300)]
+        self.expected = [self.tmpl.render(dict(row)) for row in self.rows]
+
+    def test_render_many(self):
+        self.assertEqual(list(self.tmpl.render_many(self.rows)), self.expected)
+        self.assertEqual(list(self.tmpl.render_many(iter(self.rows), threads=4, chunksize=7)), self.expected)
+
+    def test_processes(self):
+        results = self.tmpl.render_many(self.rows, processes=2, chunksize=16)
+        self.assertEqual(list(results), self.expected)
+
+    def test_outputs(self):
+        for kwargs in ({}, {"threads": 2}):
+            outputs = [io.StringIO() for _ in self.rows]
+            written = list(self.tmpl.render_many(self.rows, outputs, **kwargs))
+            self.assertEqual(written, outputs)
+            self.assertEqual([output.getvalue() for output in outputs], self.expected)
+
+    def test_escape(self):
+        tmpl = stencil.Template("{{ a }}")
+        self.assertEqual(list(tmpl.render_many([{"a": "x"}, {"a": "<"}], escape=shout)), ["X", "<"])
+        context = stencil.Context({"a": "<"})
+        self.assertEqual(list(tmpl.render_many([context, {"a": "&"}])), ["&lt;", "&amp;"])
+
+    def test_renderer(self):
+        render = self.tmpl.renderer()
+        self.assertEqual([render(row) for row in self.rows], self.expected)
+
+    def test_pickle_loader(self):
+        self.loader.fragment_cache = stencil.LocalCache(maxsize=5)
+        loader = pickle.loads(pickle.dumps(self.loader))  # noqa: S301
+        self.assertEqual(loader.paths, self.loader.paths)
+        self.assertEqual(loader.fragment_cache.maxsize, 5)
+        self.assertEqual(len(loader), 0)
+        tmpl = pickle.loads(pickle.dumps(self.tmpl))  # noqa: S301
+        self.assertEqual(tmpl.render(self.rows[3]), self.expected[3])
@@ -0,0 +1,48 @@
+import unittest
+
+from stencil import Context, ForTag, IfTag, Template, TextTag, VarTag, WithTag
+
+
+class OptimiseTests(unittest.TestCase):
+    def assert_nodes(self, src, types, data=None):
+        tmpl = Template(src)
+        self.assertEqual([type(node) for node in tmpl.nodelist], types)
+        expected = Template(src, optimise=False).render(Context(dict(data or {})))
+        self.assertEqual(tmpl.render(Context(dict(data or {}))), expected)
+        return tmpl
+
+    def test_merge_text(self):
+        tmpl = self.assert_nodes("a {# note #} b {% load tests.test_lib %} c", [TextTag])
+        self.assertEqual(tmpl.nodelist[0].content, "a  b  c")
+
+    def test_literal_var(self):
+        # The escape function is chosen by the Context, so even constant values are escaped when rendered.
+        src = "{{ 'a' }} {{ '50%' }} {{ 1 }}"
+        self.assert_nodes(src, [VarTag, TextTag, VarTag, TextTag, VarTag])
+        context = Context({}, escape=lambda value: value.replace("a", "A").replace("%", "\\%"))
+        self.assertEqual(Template(src).render(context), "A 50\\% 1")
+
+    def test_constants_overridden(self):
+        src = "{% if True %}yes{% else %}no{% endif %}{{ None }}"
+        self.assert_nodes(src, [IfTag, VarTag])
+        self.assertEqual(Template(src).render({"True": False, "None": "!"}), "no!")
+
+    def test_dead_branch(self):
+        tmpl = self.assert_nodes("a{% if 1 %}b{% else %}{{ x }}{% endif %}c", [TextTag])
+        self.assertEqual(tmpl.nodelist[0].content, "abc")
+        self.assert_nodes("a{% if not 1 %}b{% endif %}c", [TextTag])
+        self.assert_nodes("{% if x %}b{% endif %}", [IfTag], {"x": 1})
+
+    def test_keeps_blocks(self):
+        self.assert_nodes("{% if 0 %}{% block a %}{% endblock %}{% endif %}", [IfTag])
+
+    def test_static_subtree(self):
+        self.assert_nodes("{% with a=b %}<1>{% endwith %}", [TextTag])
+        self.assert_nodes("{% with a=f() %}x{% endwith %}", [WithTag], {"f": lambda: 1})
+        tmpl = self.assert_nodes("{% for x in 'abc' %}-{% endfor %}", [TextTag])
+        self.assertEqual(tmpl.nodelist[0].content, "---")
+        self.assert_nodes("{% for x in 'abc' %}{{ x }}{% endfor %}", [ForTag])
+
+    def test_prerender_error(self):
+        tmpl = self.assert_nodes("{% if x %}{% for a in 5 %}-{% endfor %}{% endif %}", [IfTag])
+        self.assertRaises(TypeError, tmpl.render, {"x": True})
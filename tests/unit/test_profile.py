@@ -0,0 +1,88 @@
+import threading
+
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+class OriginTestCase(LoaderTestCase):
+    def test_lines(self):
+        tokens = list(stencil.tokenise("a\n{{ x }}\n{% if y\n %}\nb{% endif %}"))
+        self.assertEqual([tok.line for tok in tokens], [1, 2, 2, 3, 4, 5])
+
+    def test_origin(self):
+        tmpl = stencil.Template("a\n{{ x }}\n{% for y in z %}\n{{ y }}{% endfor %}", name="t")
+        self.assertEqual([node.origin for node in tmpl.nodelist], [
+            ("t", 1, "text"), ("t", 2, "{{ x }}"), ("t", 2, "text"), ("t", 3, "{% for y in z %}"),
+        ])  # fmt: skip
+        self.assertEqual(tmpl.nodelist[3].nodelist[1].origin, ("t", 4, "{{ y }}"))
+
+
+class ProfilerTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("base.html", "<{% block a %}{% endblock %}>")
+        self.write(
+            "page.html",
+            '{% extends "base.html" %}\n{% block a %}{% for x in xs %}\n{% include "row.html" %}{% endfor %}'
+            "{% endblock %}",
+        )
+        self.write("row.html", "[{{ x }}]")
+        self.loader = stencil.TemplateLoader([self.root / "tmpl"])
+
+    def test_profile(self):
+        tmpl = self.loader["page.html"]
+        render = stencil.Nodelist.render
+        with stencil.Profiler() as profiler:
+            self.assertEqual(tmpl.render({"xs": range(3)}), "<\n[0]\n[1]\n[2]>")
+        self.assertIs(stencil.Nodelist.render, render)
+
+        nodes = profiler.node_stats()
+        self.assertEqual(nodes["page.html", 3, '{% include "row.html" %}'].calls, 3)
+        self.assertEqual(nodes["row.html", 1, "{{ x }}"].calls, 3)
+        loop = nodes["page.html", 2, "{% for x in xs %}"]
+        self.assertEqual(loop.calls, 1)
+        self.assertGreaterEqual(loop.total, loop.own)
+        self.assertEqual(list(profiler.template_stats()), ["base.html", "page.html", "row.html"])
+        self.assertIn("page.html:3", profiler.report())
+
+        stacks = dict(line.rsplit(" ", 1) for line in profiler.collapsed().splitlines())
+        self.assertIn(
+            'base.html:1 {% block a %};page.html:2 {% for x in xs %};page.html:3 {% include "row.html" %};'
+            "row.html:1 {{ x }}",
+            stacks,
+        )
+
+    def test_recursive(self):
+        self.write(
+            "tree.html", "{{ n }}{% if n %}{% with n=dec(n) %}{% include 'tree.html' %}{% endwith %}{% endif %}"
+        )
+        tmpl = self.loader["tree.html"]
+        with stencil.Profiler() as profiler:
+            tmpl.render({"n": 3, "dec": lambda n: n - 1})
+        (name, stats), *_ = profiler.template_stats().items()
+        self.assertEqual(name, "tree.html")
+        self.assertLessEqual(stats.total, sum(node.own for node in profiler.node_stats().values()) * 1.01)
+
+    def test_overlapping(self):
+        tmpl = self.loader["row.html"]
+        render = stencil.Nodelist.render
+        a, b = stencil.Profiler(), stencil.Profiler()
+        a.__enter__()
+        b.__enter__()
+        tmpl.render({"x": 1})
+        a.__exit__(None, None, None)
+        tmpl.render({"x": 2})
+        self.assertIsNot(stencil.Nodelist.render, render)
+        b.__exit__(None, None, None)
+        self.assertIs(stencil.Nodelist.render, render)
+        self.assertEqual(a.node_stats()["row.html", 1, "{{ x }}"].calls, 1)
+        self.assertEqual(b.node_stats()["row.html", 1, "{{ x }}"].calls, 2)
+
+    def test_other_thread(self):
+        tmpl = self.loader["row.html"]
+        with stencil.Profiler() as profiler:
+            thread = threading.Thread(target=tmpl.render, args=({"x": 1},))
+            thread.start()
+            thread.join()
+            tmpl.render({"x": 2})
+        self.assertEqual(profiler.node_stats()["row.html", 1, "{{ x }}"].calls, 1)
@@ -37,3 +37,82 @@ class ContextTestCase(unittest.TestCase):
         with ctx.push({"a": 2}):
             self.assertEqual(ctx["a"], 2)
         self.assertEqual(ctx["a"], 1)
+
+
+class FlatContextTestCase(unittest.TestCase):
+    def test_push(self):
+        ctx = stencil.FlatContext({"a": 1}, {"a": 3, "b": 4})
+        self.assertEqual(ctx["a"], 1)
+        self.assertEqual(ctx["b"], 4)
+        self.assertIsNone(ctx["None"])
+        with ctx.push({"a": 2, "c": 5}):
+            ctx["b"] = 6
+            ctx["b"] = 7
+            self.assertEqual((ctx["a"], ctx["b"], ctx["c"]), (2, 7, 5))
+        self.assertEqual(ctx, {"a": 1, "b": 4, "True": True, "False": False, "None": None})
+
+    def test_new_child(self):
+        ctx = stencil.FlatContext({"a": 1}, escape=str.upper)
+        child = ctx.new_child({"a": 2})
+        self.assertEqual((child["a"], ctx["a"]), (2, 1))
+        self.assertIs(child.escape, str.upper)
+
+    def test_render(self):
+        tmpl = stencil.Template("{% for a in b %}{% with c=a %}{{ c }}{% endwith %}{% endfor %}{{ a }}")
+        self.assertEqual(tmpl.render(stencil.FlatContext({"a": 0, "b": [1, 2]})), "120")
+
+
+class EscapeTestCase(unittest.TestCase):
+    class Markup(str):
+        def __html__(self):
+            return self
+
+    class Html:
+        def __html__(self):
+            return "<em>html</em>"
+
+    def test_format_value(self):
+        values = [
+            "plain", "<a href=\"x\">'&'</a>", 12, -3.5, True, None, [1, "<"], stencil.SafeStr("<b>"),
+            self.Markup("<i>"), self.Html(),
+        ]  # fmt: skip
+        expected = [
+            "plain", "&lt;a href=&quot;x&quot;&gt;&#x27;&amp;&#x27;&lt;/a&gt;", "12", "-3.5", "True", "None",
+            "[1, &#x27;&lt;&#x27;]", "<b>", "<i>", "<em>html</em>",
+        ]  # fmt: skip
+        tmpl = stencil.Template("{{ x }}")
+        compiled = stencil.Template("{{ x }}", compiled=True)
+        for value, result in zip(values, expected, strict=True):
+            with self.subTest(value=value):
+                self.assertEqual(stencil.format_value(value, stencil.html.escape), result)
+                self.assertEqual(tmpl.render({"x": value}), result)
+                self.assertEqual(compiled.render({"x": value}), result)
+                self.assertEqual("".join(tmpl.stream({"x": value})), result)
+
+    def test_custom_escape(self):
+        tmpl = stencil.Template("{{ a }}{{ b }}")
+        self.assertEqual(tmpl.render(stencil.Context({"a": "x", "b": 1}, escape=lambda s: f"[{s}]")), "[x][1]")
+
+    def test_unhashable_escape(self):
+        class Escape:
+            __hash__ = None
+
+            def __call__(self, value):
+                return f"[{value}]"
+
+        for compiled in (False, True):
+            tmpl = stencil.Template("{{ a }}{{ b }}", compiled=compiled)
+            self.assertEqual(tmpl.render(stencil.Context({"a": "x", "b": 1}, escape=Escape())), "[x][1]")
+
+    def test_fast_escape(self):
+        calls = []
+
+        def escape(value):
+            calls.append(value)
+            return stencil.html.escape(value)
+
+        stencil.HTML_ESCAPES.add(escape)
+        self.addCleanup(stencil.HTML_ESCAPES.discard, escape)
+        tmpl = stencil.Template("{{ a }}{{ b }}{{ c }}")
+        self.assertEqual(tmpl.render(stencil.Context({"a": "x", "b": 1, "c": "<"}, escape=escape)), "x1&lt;")
+        self.assertEqual(calls, ["<"])
@@ -0,0 +1,44 @@
+import unittest
+
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+CHUNK_SIZE = 100
+
+
+class StreamTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("base.html", "<h1>{% block title %}Base{% endblock %}</h1>{% block body %}{% endblock %}")
+        self.write("row.html", "<td>{{ x }}</td>")
+        self.write(
+            "page.html",
+            '{% extends "base.html" %}{% block title %}{{ block.super }} & Page{% endblock %}'
+            '{% block body %}{% for x in rows %}{% include "row.html" x=x %}{% endfor %}{% endblock %}',
+        )
+        self.loader = stencil.TemplateLoader([self.root / "tmpl"])
+
+    def test_matches_render(self):
+        tmpl = self.loader["page.html"]
+        expected = tmpl.render({"rows": range(1000)})
+        chunks = list(tmpl.stream({"rows": range(1000)}, chunk_size=CHUNK_SIZE))
+        self.assertEqual("".join(chunks), expected)
+        self.assertTrue(expected.startswith("<h1>Base & Page</h1><td>0</td>"))
+        self.assertGreater(len(chunks), 10)
+        self.assertTrue(all(len(chunk) >= CHUNK_SIZE for chunk in chunks[:-1]))
+
+    def test_lazy(self):
+        def rows():
+            yield 1
+            raise RuntimeError("Stopped")
+
+        seen = []
+        with self.assertRaises(RuntimeError):
+            # extend() keeps the chunks received before the error
+            seen.extend(self.loader["page.html"].stream({"rows": rows()}, chunk_size=1))
+        self.assertEqual("".join(seen), "<h1>Base & Page</h1><td>1</td>")
+
+
+class BlockSuperTestCase(unittest.TestCase):
+    def test_super_without_parent(self):
+        self.assertEqual(stencil.Template("{% block a %}x{{ block.super }}{% endblock %}").render({}), "x")
@@ -0,0 +1,100 @@
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+class ConcurrentRenderTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("base.html", "[{% block head %}base{% endblock %}|{% block body %}{% endblock %}]")
+        self.write(
+            "child.html",
+            '{% extends "base.html" %}{% block head %}{{ n }}:{{ block.super }}{% endblock %}'
+            '{% block body %}{% for x in xs %}{% include "row.html" x=x %}{% endfor %}{% endblock %}',
+        )
+        self.write("row.html", "<{{ x }}>")
+        self.write("dynamic.html", "{% extends parent %}{% block body %}{{ n }}{{ block.super }}{% endblock %}")
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+
+    @staticmethod
+    def expected(name, n):
+        rows = "".join(f"<{x}>" for x in range(n % 7))
+        if name == "child.html":
+            return f"[{n}:base|{rows}]"
+        return f"[{n}:base|{n}{rows}]"
+
+    def test_concurrent(self):
+        for compiled in (False, True):
+            loader = stencil.TemplateLoader([self.root / "tmpl"], compiled=compiled, maxsize=3)
+
+            def render(n):
+                name = ("child.html", "dynamic.html")[n % 2]
+                data = {"n": n, "xs": range(n % 7), "parent": "child.html"}
+                return name, n, loader[name].render(data)
+
+            with ThreadPoolExecutor(8) as pool:
+                for name, n, result in pool.map(render, range(400)):
+                    self.assertEqual(result, self.expected(name, n))
+
+
+class SingleFlightTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loads = []
+        self.gate = threading.Event()
+
+    def loader(self):
+        loader = stencil.TemplateLoader([self.root / "tmpl"])
+        load = loader.load
+
+        def slow_load(name):
+            self.loads.append(name)
+            self.gate.wait(5)
+            return load(name)
+
+        loader.load = slow_load
+        return loader
+
+    def test_shared_load(self):
+        self.write("page.html", "{{ n }}")
+        loader = self.loader()
+        with ThreadPoolExecutor(8) as pool:
+            futures = [pool.submit(loader.__getitem__, "page.html") for _ in range(8)]
+            time.sleep(0.05)
+            self.gate.set()
+            results = {id(future.result()) for future in futures}
+        self.assertEqual(self.loads, ["page.html"])
+        self.assertEqual(len(results), 1)
+        self.assertEqual(loader.misses, 1)
+        self.assertFalse(loader.loading)
+
+    def test_shared_error(self):
+        self.write("page.html", "{% for x %}{% endfor %}")
+        loader = self.loader()
+        with ThreadPoolExecutor(4) as pool:
+            futures = [pool.submit(loader.__getitem__, "page.html") for _ in range(4)]
+            time.sleep(0.05)
+            self.gate.set()
+            for future in futures:
+                self.assertRaises(ValueError, future.result)
+        self.assertEqual(self.loads, ["page.html"])
+        # Failures are not cached
+        self.write("page.html", "fixed")
+        self.assertEqual(loader["page.html"].render({}), "fixed")
+        self.assertEqual(len(self.loads), 2)
+
+    def test_cycle(self):
+        self.write("a.html", '{% extends "b.html" %}')
+        self.write("b.html", '{% extends "a.html" %}')
+        self.gate.set()
+        loader = self.loader()
+        with self.assertRaises(RecursionError):
+            loader["a.html"]
+        self.assertFalse(loader.loading)
+        self.assertNotIn("a.html", loader)
@@ -0,0 +1,103 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+import stencil
+from tests.unit.test_loader import LoaderTestCase
+
+
+class DependencyTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("base.html", "<{% block a %}{% endblock %}>")
+        self.write("page.html", '{% extends "base.html" %}{% block a %}{% include "row.html" %}{% endblock %}')
+        self.write("row.html", "row")
+        self.write("other.html", '{% include "row.html" %}!')
+        self.write("alone.html", "alone")
+        self.loader = stencil.TemplateLoader([self.root / "tmpl"])
+        for name in ("page.html", "other.html", "alone.html"):
+            self.loader[name]
+
+    def test_graph(self):
+        self.assertEqual(self.loader.dependents["base.html"], {"page.html"})
+        self.assertEqual(self.loader.dependents["row.html"], {"page.html", "other.html"})
+
+    def test_invalidate(self):
+        self.assertEqual(self.loader.invalidate("row.html"), {"row.html", "page.html", "other.html"})
+        self.assertEqual(set(self.loader), {"base.html", "alone.html"})
+        self.assertEqual(self.loader.invalidate("base.html"), {"base.html"})
+        self.assertEqual(self.loader.invalidate("missing.html"), set())
+
+    def test_reload(self):
+        self.write("row.html", "new")
+        self.loader.invalidate("row.html")
+        self.assertEqual(self.loader["page.html"].render({}), "<new>")
+        self.assertEqual(self.loader.dependents["row.html"], {"page.html"})
+
+
+class WatcherTestCase(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("base.html", "<{% block a %}{% endblock %}>")
+        self.write("page.html", '{% extends "base.html" %}{% block a %}page{% endblock %}')
+        self.loader = stencil.TemplateLoader([self.root / "tmpl"])
+        self.loader["page.html"]
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out waiting for the watcher")
+            time.sleep(0.01)
+
+    def check(self, watcher):
+        with watcher:
+            self.write("base.html", "[{% block a %}{% endblock %}]")
+            self.wait_for(lambda: "page.html" not in self.loader)
+            self.assertEqual(self.loader["page.html"].render({}), "[page]")
+        self.assertFalse(watcher.thread.is_alive())
+
+    def test_polling(self):
+        os.utime(self.root / "tmpl" / "base.html", ns=(0, 0))  # Differ from the rewrite, however fast
+        self.loader.invalidate("base.html")
+        self.loader["page.html"]
+        self.check(stencil.PollingWatcher(self.loader, interval=0.01))
+
+    def test_inotify(self):
+        try:
+            watcher = stencil.InotifyWatcher(self.loader)
+        except OSError:
+            raise unittest.SkipTest("inotify is not available") from None
+        self.check(watcher)
+
+    def test_new_directory(self):
+        try:
+            watcher = stencil.InotifyWatcher(self.loader)
+        except OSError:
+            raise unittest.SkipTest("inotify is not available") from None
+        with watcher:
+            (self.root / "tmpl" / "sub").mkdir()
+            directories = 2  # tmpl and tmpl/sub
+            self.wait_for(lambda: len(watcher.watches) == directories)
+            self.write("sub/a.html", "a")
+            self.loader["sub/a.html"]
+            self.write("sub/a.html", "b")
+            self.wait_for(lambda: "sub/a.html" not in self.loader)
+
+    def test_watch(self):
+        watcher = self.loader.watch(interval=0.01)
+        self.addCleanup(watcher.stop)
+        self.assertIsInstance(watcher, stencil.Watcher)
+        self.assertTrue(watcher.thread.is_alive())
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, stencil.Watcher, self.loader)
+
+    def test_fallback(self):
+        for patch in (mock.patch("sys.platform", "win32"), mock.patch("ctypes.util.find_library", return_value=None)):
+            with patch:
+                self.assertRaises(OSError, stencil.InotifyWatcher, self.loader)
+                watcher = self.loader.watch(interval=0.01)
+            self.addCleanup(watcher.stop)
+            self.assertIsInstance(watcher, stencil.PollingWatcher)